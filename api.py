@@ -1,38 +1,217 @@
 from flask import Flask, request, jsonify, abort, Blueprint, send_from_directory
 from dotenv import load_dotenv
 import os
-import subprocess
+import copy
 import threading
-import re
 import sqlite3
 import uuid
+import hashlib
+import json
 import logging
-from queue import Queue
+import socket
+import ipaddress
+import ssl
+import http.client
+from urllib.parse import urlparse
+from queue import Queue, Empty
 from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_v1_5
 from base64 import b64decode
 import time
 
+import torch
+
+from inference import parse_args
+from src.pipeline import SadTalkerPipeline
+
 load_dotenv()
 
 
+class IndexedQueue(Queue):
+    """
+    记录每个任务入队序号的 FIFO 队列，可以在 O(1) 时间内查询任务在队列中的位置。
+    元素为 (task_id, ...) 元组。出队总是从队头取，队内任务的序号是连续的，
+    所以任务位置 = 任务序号 - 队头序号。
+    """
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.seq_index = {}
+        self.head_seq = 0
+        self.tail_seq = 0
+
+    # _put/_get 由 Queue 在持有 self.mutex 时调用
+    def _put(self, item):
+        super()._put(item)
+        self.seq_index[item[0]] = self.tail_seq
+        self.tail_seq += 1
+
+    def _get(self):
+        item = super()._get()
+        self.seq_index.pop(item[0], None)
+        self.head_seq += 1
+        return item
+
+    def position(self, task_id):
+        with self.mutex:
+            seq = self.seq_index.get(task_id)
+            if seq is None:
+                return -1
+            return seq - self.head_seq
+
+
+class ConnectionPool:
+    """
+    sqlite 连接池，连接在线程之间复用，不再每次操作都新建连接。
+    所有连接都使用 WAL 模式，读请求不会被 worker 的写入阻塞。
+    """
+
+    def __init__(self, database, size=8):
+        self.database = database
+        self._idle = Queue()
+        self._slots = threading.Semaphore(size)
+
+    def _connect(self):
+        db_conn = sqlite3.connect(self.database, check_same_thread=False, timeout=30)
+        db_conn.execute('PRAGMA journal_mode=WAL')
+        # WAL 模式下 NORMAL 已经能保证数据库不损坏，省去每次提交的 fsync
+        db_conn.execute('PRAGMA synchronous=NORMAL')
+        return db_conn
+
+    @contextmanager
+    def connection(self):
+        """
+        借出一个连接，with 块内的语句在同一个事务中提交，出错时回滚。
+        """
+        with self._slots:
+            try:
+                db_conn = self._idle.get_nowait()
+            except Empty:
+                db_conn = self._connect()
+            try:
+                with db_conn:
+                    yield db_conn
+            finally:
+                self._idle.put(db_conn)
+
+
+class TicketVerifier:
+    """
+    校验客户端的 ticket。
+    私钥只在文件修改后重新加载；校验通过的 (openid, ticket) 会缓存到 ticket 过期为止，
+    客户端频繁轮询时不必每次都做 RSA 解密。缓存按 LRU 淘汰，最多保存 cache_size 条。
+    """
+
+    def __init__(self, key_path, token_threshold, check_expire, cache_size=4096):
+        self.key_path = key_path
+        self.token_threshold = token_threshold
+        self.check_expire = check_expire
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._key = None
+        self._key_mtime = None
+        self._verified = OrderedDict()
+
+    def _get_key(self):
+        mtime = os.stat(self.key_path).st_mtime_ns
+        with self._lock:
+            if mtime != self._key_mtime:
+                with open(self.key_path, 'r') as priv_file:
+                    self._key = RSA.import_key(priv_file.read())
+                self._key_mtime = mtime
+                # 私钥换了，之前校验通过的 ticket 全部作废
+                self._verified.clear()
+                logger.info(f"加载私钥 {self.key_path}")
+            return self._key
+
+    def _get_cached(self, openid, ticket):
+        with self._lock:
+            expire_at = self._verified.get((openid, ticket))
+            if expire_at is None:
+                return False
+            if time.time() > expire_at:
+                del self._verified[(openid, ticket)]
+                return False
+            self._verified.move_to_end((openid, ticket))
+            return True
+
+    def _put_cached(self, openid, ticket, expire_at):
+        with self._lock:
+            self._verified[(openid, ticket)] = expire_at
+            self._verified.move_to_end((openid, ticket))
+            while len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+
+    def verify(self, openid, ticket):
+        """
+        :return: 校验失败时返回错误信息，通过时返回 None
+        """
+        private_key = self._get_key()
+        if self._get_cached(openid, ticket):
+            return None
+
+        # 解密ticket
+        cipher = PKCS1_v1_5.new(private_key)
+        decoded_ticket = b64decode(ticket)
+        decrypted_ticket = cipher.decrypt(decoded_ticket, None).decode('utf-8')
+        logger.debug(f"Decrypted ticket: {decrypted_ticket}")
+        # 验证格式和时间戳
+        if not decrypted_ticket.startswith(openid):
+            return "Invalid authentication"
+        ticket_timestamp = int(decrypted_ticket[len(openid):])
+        if self.check_expire:
+            if time.time() - ticket_timestamp > self.token_threshold:
+                logger.debug(f"Authentication expired for openid: {openid}")
+                return "Authentication expired"
+            expire_at = ticket_timestamp + self.token_threshold
+        else:
+            # ticket 不会过期，缓存也只保留一个有效期，避免长期占用
+            expire_at = time.time() + self.token_threshold
+        self._put_cached(openid, ticket, expire_at)
+        return None
+
+
+class TaskWaiters:
+    """
+    长轮询请求按任务id在这里等待，任务的最终状态写入数据库后被唤醒。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # task_id -> [Event, 等待者数量]
+        self._events = {}
+
+    @contextmanager
+    def waiting(self, task_id):
+        with self._lock:
+            entry = self._events.setdefault(task_id, [threading.Event(), 0])
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0 and self._events.get(task_id) is entry:
+                    del self._events[task_id]
+
+    def notify(self, task_id):
+        with self._lock:
+            entry = self._events.get(task_id)
+            if entry is not None:
+                entry[0].set()
+
+
 def find_position_in_queue(q, task_id):
     """
     查找队列中元素的位置
-    :param q: 队列对象
+    :param q: IndexedQueue 队列对象
     :param task_id: 要查找的元素id
     :return: 元素在队列中的位置，如果没有找到则返回-1
     """
-    # fixme: 没加锁，因为自带的queue不方便查找只能遍历 ，量大了会严重阻塞
-    # with q.mutex:  # 使用队列的锁来确保线程安全
-    # 将队列转换为列表
-    queue_list = list(q.queue)
-    # 遍历list，按照其中tuple的task id，尝试找到元素的位置
-    for task_tuple in queue_list:
-        if len(task_tuple) > 0 and task_tuple[0] == task_id:
-            return queue_list.index(task_tuple)
-    return -1
+    return q.position(task_id)
 
 
 class Config:
@@ -40,13 +219,37 @@ class Config:
 
     tokenExpire = os.environ.get("TOKEN_EXPIRE", "")
     tokenThreshold = int(float(_tokenValidPeriod) * 60)
-    pythonPath = os.environ.get("PYTHON_PATH", "/root/miniconda3/envs/sadtalker/bin/python")
     logLevel = os.environ.get("LOG_LEVEL", "DEBUG")
     uploadDir = os.environ.get("UPLOAD_DIR", 'uploads/')
     resultDir = os.environ.get("RESULT_DIR", 'results/')
     apiPort = os.environ.get("API_PORT", "5000")
     prod = os.environ.get("FLASK_DEBUG", "false")
     stArg = os.environ.get("ST_ARG", "")
+    # 逗号分隔的设备列表，如 "cuda:0,cuda:1" 或 "cpu"，worker 按顺序轮流分配；留空则按 ST_ARG 自动选择
+    workerDevices = os.environ.get("WORKER_DEVICES", "")
+    # worker 数量，每个 worker 持有一份常驻模型；0 表示每个设备一个 worker
+    workerNum = int(os.environ.get("WORKER_NUM", "0"))
+    # 每个 cpu worker 的 torch 线程数；0 表示按 cpu 核数平均分配
+    workerCpuThreads = int(os.environ.get("WORKER_CPU_THREADS", "0"))
+    # 长轮询最长等待秒数
+    longPollTimeout = float(os.environ.get("LONG_POLL_TIMEOUT", "30"))
+    # 回调失败时的重试次数和每次请求的超时秒数
+    callbackRetry = int(os.environ.get("CALLBACK_RETRY", "3"))
+    callbackTimeout = float(os.environ.get("CALLBACK_TIMEOUT", "10"))
+    # 并发发送回调的线程数，不可达的回调地址不会阻塞其他任务的回调
+    callbackWorkers = int(os.environ.get("CALLBACK_WORKERS", "4"))
+    # 逗号分隔的回调主机白名单；留空时拒绝解析到回环、链路本地、内网等非公网地址的主机
+    callbackAllowedHosts = os.environ.get("CALLBACK_ALLOWED_HOSTS", "")
+    # 由前置的 nginx/apache 通过 X-Sendfile 直接发送文件
+    useXSendfile = os.environ.get("USE_X_SENDFILE", "")
+    ticketCacheSize = int(os.environ.get("TICKET_CACHE_SIZE", "4096"))
+    # sqlite 数据库路径。WAL 模式会在同一目录下写 -wal/-shm 文件，容器中要挂载整个目录而不是单个数据库文件
+    dbPath = os.environ.get("DB_PATH", "tasks.db")
+    dbPoolSize = int(os.environ.get("DB_POOL_SIZE", "8"))
+    # 一个事务中最多合并写入的状态更新数
+    statusBatchSize = int(os.environ.get("STATUS_BATCH_SIZE", "64"))
+    # 任务租约的有效期（秒），运行中的任务每隔三分之一有效期续约一次，过期未续约的任务会被重新放回队列
+    taskLeaseTimeout = float(os.environ.get("TASK_LEASE_TIMEOUT", "300"))
 
 
 TASK_STATUS_PENDING = "pending"
@@ -54,25 +257,46 @@ TASK_STATUS_RUNNING = "running"
 TASK_STATUS_SUCCESS = "success"
 TASK_STATUS_MISSING = "missing_result"
 TASK_STATUS_FAILED = "failed"
-
-DB = 'tasks.db'
+# 任务到达这些状态后不会再变化
+TASK_FINAL_STATUSES = {TASK_STATUS_SUCCESS, TASK_STATUS_MISSING, TASK_STATUS_FAILED}
 
 config = Config()
 
+DB = config.dbPath
+if os.path.dirname(DB):
+    os.makedirs(os.path.dirname(DB), exist_ok=True)
+
 ALLOWED_EXTENSIONS = {'mov', 'png', 'jpg', 'jpeg', 'gif', 'mp3', 'wav', 'm4a', 'mp4', 'heic'}
 root = Blueprint('sadTalker', __name__, url_prefix="/sadTalker")
 app = Flask(__name__)
-
-# 创建一个队列
-task_queue = Queue()
+app.config['USE_X_SENDFILE'] = bool(config.useXSendfile)
+
+# 创建一个队列，只作为 worker 的分发顺序和排队位置索引，任务本身持久化在数据库中
+task_queue = IndexedQueue()
+# 状态更新先进入这个队列，由 status_writer 线程批量写入数据库
+status_updates = Queue()
+# 任务结束后要发送的回调 (callback_url, task_id, status, result, 已尝试次数)
+callbacks = Queue()
+task_waiters = TaskWaiters()
+db_pool = ConnectionPool(DB, config.dbPoolSize)
+ticket_verifier = TicketVerifier('certs/private.pem', config.tokenThreshold, bool(config.tokenExpire),
+                                 config.ticketCacheSize)
 # 创建数据库和表（如果不存在的话）
-conn = sqlite3.connect(DB, check_same_thread=False)
-with conn:
-    conn.execute('''CREATE TABLE IF NOT EXISTS tasks
+with db_pool.connection() as c:
+    c.execute('''CREATE TABLE IF NOT EXISTS tasks
              (id TEXT PRIMARY KEY, result TEXT, status TEXT)''')
+    # 旧版本的表只有 id/result/status，补齐持久化队列需要的列
+    _task_columns = {row[1] for row in c.execute('PRAGMA table_info(tasks)')}
+    for _column, _column_type in (('photo', 'TEXT'), ('audio', 'TEXT'), ('created_at', 'REAL'),
+                                  ('worker', 'TEXT'), ('claimed_at', 'REAL'), ('fingerprint', 'TEXT'),
+                                  ('callback_url', 'TEXT')):
+        if _column not in _task_columns:
+            c.execute(f'ALTER TABLE tasks ADD COLUMN {_column} {_column_type}')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks (status, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tasks_fingerprint ON tasks (fingerprint, status)')
 
 # 配置日志
-logging.basicConfig(level=config.logLevel, format='[%(filename)s:%(lineno)d] %(asctime)s %(levelname)s:%(message)s')
+logging.basicConfig(level=config.logLevel, format='[%(filename)s:%(lineno)d] [%(threadName)s] %(asctime)s %(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
 
 
@@ -80,15 +304,101 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def save_upload(file, chunk_size=1024 * 1024):
+    """
+    分块把上传文件写入磁盘并同时计算 sha256，按内容哈希命名存储，
+    相同内容只保存一份，不同用户的同名文件也不会互相覆盖。
+
+    :param file: 上传的文件对象
+    :param chunk_size: 每次读取的字节数
+    :return: (保存路径, 内容哈希)
+    """
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    tmp_filename = os.path.join(config.uploadDir, f".{uuid.uuid4()}.tmp")
+    sha256 = hashlib.sha256()
+    with open(tmp_filename, 'wb') as f:
+        while True:
+            chunk = file.stream.read(chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            f.write(chunk)
+    content_hash = sha256.hexdigest()
+    filename = os.path.join(config.uploadDir, f"{content_hash}.{ext}")
+    # 内容相同的文件可能已经存在，直接覆盖也是同样的内容
+    os.replace(tmp_filename, filename)
+    return filename, content_hash
+
+
+def task_fingerprint(photo_hash, audio_hash):
+    """
+    相同输入和相同参数的任务得到相同的指纹，用来复用已经完成的结果。
+    """
+    return hashlib.sha256('\n'.join([photo_hash, audio_hash, ' '.join(process_st_args(config.stArg))]).encode('utf-8')).hexdigest()
+
+
+def find_finished_result(fingerprint):
+    """
+    查找指纹相同且已经成功完成的任务结果。
+
+    :return: 结果文件名，没有可复用的结果时返回 None
+    """
+    with db_pool.connection() as c:
+        rows = c.execute('SELECT result FROM tasks WHERE fingerprint=? AND status=? AND result IS NOT NULL '
+                         'ORDER BY created_at DESC', (fingerprint, TASK_STATUS_SUCCESS)).fetchall()
+    for (result,) in rows:
+        # 结果文件可能已经被清理
+        if os.path.isfile(os.path.join(config.resultDir, result)):
+            return result
+    return None
+
+
 def process_st_args(arg_string):
-    return arg_string.split(" ")
+    return arg_string.split()
+
+
+def get_worker_devices():
+    """
+    按配置给每个 worker 分配设备。
+
+    :return: 设备列表，每个元素对应一个 worker，None 表示沿用 ST_ARG 自动选择的设备
+    """
+    devices = [d.strip() for d in config.workerDevices.split(',') if d.strip()]
+    if not devices:
+        devices = [None]
+    num = config.workerNum if config.workerNum > 0 else len(devices)
+    return [devices[i % len(devices)] for i in range(num)]
+
+
+def load_pipeline(device=None, cpu_threads=0):
+    """
+    按 ST_ARG 解析出公共参数并在当前线程加载常驻模型，模型只加载一次，后续任务复用。
+
+    :param device: 当前 worker 使用的设备，None 表示自动选择
+    :param cpu_threads: 设备为 cpu 时当前线程使用的 torch 线程数，0 表示不限制
+    :return: (公共参数, 常驻的 SadTalkerPipeline)
+    """
+    # 结果统一写到 resultDir，ST_ARG 中的 --result_dir 仍可覆盖
+    base_args = parse_args(['--result_dir', config.resultDir] + process_st_args(config.stArg))
+    if device:
+        base_args.device = device
+    torch_device = torch.device(base_args.device)
+    if torch_device.type == 'cuda' and torch_device.index is not None:
+        # 部分模块按当前默认 gpu 创建张量，需要绑定到本线程的 gpu
+        torch.cuda.set_device(torch_device)
+    elif torch_device.type == 'cpu' and cpu_threads > 0:
+        torch.set_num_threads(cpu_threads)
+    logger.info(f"加载常驻模型, 参数: {base_args}")
+    return base_args, SadTalkerPipeline(base_args)
 
 
 def authenticate(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        openid = request.form.get('openid')
-        ticket = request.form.get('ticket')
+        # 只有 GET 下载的认证信息放在查询参数里，其他接口仍然只从表单读取
+        credentials = request.args if request.method == 'GET' else request.form
+        openid = credentials.get('openid')
+        ticket = credentials.get('ticket')
 
         logger.debug(f"Authenticating with openid: {openid}, ticket: {ticket}")
 
@@ -97,22 +407,9 @@ def authenticate(f):
             return jsonify(error="Authentication required"), 401
 
         try:
-            # 读取私钥
-            with open('certs/private.pem', 'r') as priv_file:
-                private_key = RSA.import_key(priv_file.read())
-
-            # 解密ticket
-            cipher = PKCS1_v1_5.new(private_key)
-            decoded_ticket = b64decode(ticket)
-            decrypted_ticket = cipher.decrypt(decoded_ticket, None).decode('utf-8')
-            logger.debug(f"Decrypted ticket: {decrypted_ticket}")
-            # 验证格式和时间戳
-            if not decrypted_ticket.startswith(openid):
-                return jsonify(error="Invalid authentication"), 401
-            ticket_timestamp = int(decrypted_ticket.lstrip(openid))
-            if config.tokenExpire and (time.time() - ticket_timestamp > config.tokenThreshold):
-                logger.debug(f"Authentication expired for openid: {openid}")
-                return jsonify(error="Authentication expired"), 401
+            error = ticket_verifier.verify(openid, ticket)
+            if error:
+                return jsonify(error=error), 401
 
         except Exception as e:
             logger.debug(f"Authentication failed for openid: {e}")
@@ -132,30 +429,70 @@ def upload_file():
     audio = request.files['audio']
     if photo.filename == '' or audio.filename == '':
         return jsonify(error="No selected file"), 400
+    callback_url = request.form.get('callback_url') or None
+    if callback_url:
+        error = check_callback_url(callback_url)
+        if error:
+            return jsonify(error=error), 400
     if photo and allowed_file(photo.filename) and audio and allowed_file(audio.filename):
         task_id = str(uuid.uuid4())  # 生成唯一ID
-        photo_filename = os.path.join(config.uploadDir, photo.filename)
-        audio_filename = os.path.join(config.uploadDir, audio.filename)
-        photo.save(photo_filename)
-        audio.save(audio_filename)
-        # 将任务添加到队列
+        photo_filename, photo_hash = save_upload(photo)
+        audio_filename, audio_hash = save_upload(audio)
+        fingerprint = task_fingerprint(photo_hash, audio_hash)
+        result = find_finished_result(fingerprint)
+        if result is not None:
+            # 同样的输入已经生成过，直接复用结果
+            with db_pool.connection() as c:
+                c.execute('INSERT INTO tasks (id, result, status, photo, audio, created_at, fingerprint, callback_url) VALUES (?,?,?,?,?,?,?,?)',
+                          (task_id, result, TASK_STATUS_SUCCESS, photo_filename, audio_filename, time.time(), fingerprint, callback_url))
+            logger.info(f"任务 {task_id} 复用已有结果: {result}")
+            if callback_url:
+                callbacks.put((callback_url, task_id, TASK_STATUS_SUCCESS, result, 0))
+            return jsonify(task_id=task_id, status=TASK_STATUS_SUCCESS, result=result), 200
+        # 先持久化再入队，保证重启后任务不会丢失
+        with db_pool.connection() as c:
+            c.execute('INSERT INTO tasks (id, result, status, photo, audio, created_at, fingerprint, callback_url) VALUES (?,?,?,?,?,?,?,?)',
+                      (task_id, None, TASK_STATUS_PENDING, photo_filename, audio_filename, time.time(), fingerprint, callback_url))
         task_queue.put((task_id, photo_filename, audio_filename))
-        with conn as c:
-            c.execute('INSERT INTO tasks (id, result, status) VALUES (?,?,?)', (task_id, None, TASK_STATUS_PENDING))
         logger.info(f"任务 {task_id} 的状态更新为 {TASK_STATUS_PENDING}")
         return jsonify(task_id=task_id), 202
     else:
         return jsonify(error="File type not allowed"), 400
 
 
+def query_task(task_id):
+    """
+    :return: (result, status)，任务不存在时返回 None
+    """
+    with db_pool.connection() as c:
+        return c.execute('SELECT result, status FROM tasks WHERE id=?', (task_id,)).fetchone()
+
+
 @root.route('/status', methods=['POST'])
 @authenticate
 def get_status():
     task_id = request.form.get("task_id")
-    with conn:
-        c = conn.cursor()
-        c.execute('SELECT result, status FROM tasks WHERE id=?', (task_id,))
-        task = c.fetchone()
+    task = query_task(task_id)
+    if task:
+        return jsonify(id=task_id, result=task[0], status=task[1], index=find_position_in_queue(task_queue, task_id))
+    else:
+        abort(404)
+
+
+@root.route('/wait', methods=['POST'])
+@authenticate
+def wait_status():
+    """
+    长轮询：任务结束或等待超时后才返回，返回内容与 /status 相同。
+    可以用 timeout 指定等待秒数，最长不超过 LONG_POLL_TIMEOUT。
+    """
+    task_id = request.form.get("task_id")
+    timeout = min(request.form.get("timeout", config.longPollTimeout, type=float), config.longPollTimeout)
+    with task_waiters.waiting(task_id) as finished:
+        # 先注册再查询，避免查询之后、等待之前任务恰好结束而错过通知
+        task = query_task(task_id)
+        if task and task[1] not in TASK_FINAL_STATUSES and finished.wait(max(timeout, 0)):
+            task = query_task(task_id)
     if task:
         return jsonify(id=task_id, result=task[0], status=task[1], index=find_position_in_queue(task_queue, task_id))
     else:
@@ -172,62 +509,343 @@ def download_result():
     if not filename:
         return jsonify(error="Filename not provided"), 400
     try:
-        return send_from_directory(config.resultDir, filename, as_attachment=True)
+        return send_from_directory(os.path.abspath(config.resultDir), filename, as_attachment=True)
     except FileNotFoundError:
         abort(404)
 
 
-def update_task_status(task_id, status):
+@root.route('/download/<path:filename>', methods=['GET'])
+@authenticate
+def download_result_file(filename):
+    """
+    GET 下载结果文件，openid/ticket 放在查询参数中。
+    支持 Range 断点续传和 ETag/Last-Modified 条件请求。
+    响应标记为 private, no-cache：URL 里带着认证 ticket，CDN/代理缓存后任何拿到 URL 的人都能下载，
+    ticket 的有效期也就失去了作用；客户端续传或重新下载时用 ETag 校验即可。
+    文件内容由 WSGI 服务器的 file_wrapper（如 gunicorn 的 sendfile）或 X-Sendfile 发送，不经过 Python 读取。
+    """
+    # flask 会把相对路径当作相对于 api.py 所在目录，worker 写结果用的是当前工作目录
+    response = send_from_directory(os.path.abspath(config.resultDir), filename, as_attachment=True, conditional=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def update_task_status(task_id, status, result=None):
     """
-    更新任务状态到数据库。
+    更新任务状态，实际的数据库写入由 status_writer 批量完成。
 
     :param task_id: 要更新的任务ID
     :param status: 新的状态值
+    :param result: 结果文件名，为 None 时不更新
+    """
+    status_updates.put((task_id, status, result))
+
+
+def status_writer():
+    """
+    把积压的状态更新合并到一个事务中写入数据库，worker 不需要等待数据库提交。
+    """
+    while True:
+        batch = [status_updates.get()]
+        while len(batch) < config.statusBatchSize:
+            try:
+                batch.append(status_updates.get_nowait())
+            except Empty:
+                break
+        try:
+            finished_ids = [task_id for task_id, status, _ in batch if status in TASK_FINAL_STATUSES]
+            with db_pool.connection() as c:
+                c.executemany('UPDATE tasks SET status=?, result=COALESCE(?, result) WHERE id=?',
+                              [(status, result, task_id) for task_id, status, result in batch])
+                finished = c.execute(f'SELECT id, status, result, callback_url FROM tasks WHERE id IN '
+                                     f'({",".join("?" * len(finished_ids))})', finished_ids).fetchall() if finished_ids else []
+            for task_id, status, _ in batch:
+                logger.info(f"任务 {task_id} 的状态更新为 {status}")
+            # 写入数据库之后再通知，被唤醒的长轮询一定能查到最终状态
+            for task_id, status, result, callback_url in finished:
+                task_waiters.notify(task_id)
+                if callback_url:
+                    callbacks.put((callback_url, task_id, status, result, 0))
+        except sqlite3.Error as e:
+            logger.error(f"批量更新 {len(batch)} 个任务状态时数据库错误: {e}")
+        finally:
+            for _ in batch:
+                status_updates.task_done()
+
+
+def resolve_callback_url(callback_url):
+    """
+    解析并校验回调地址，避免客户端借回调让服务器向内网发请求。
+    配置了 CALLBACK_ALLOWED_HOSTS 时只允许白名单中的主机，否则主机解析出的地址必须都是公网地址。
+    发送回调时直接连接这里返回的地址，不再重新解析主机名，DNS rebinding 无法在校验之后换成内网地址。
+
+    :param callback_url: 上传时提供的回调地址
+    :return: (错误信息, 校验过的 ip)，地址允许时错误信息为 None
+    """
+    parsed = urlparse(callback_url)
+    try:
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    except ValueError:
+        return "Invalid callback_url", None
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return "Invalid callback_url", None
+    allowed_hosts = {host.strip().lower() for host in config.callbackAllowedHosts.split(',') if host.strip()}
+    if allowed_hosts and parsed.hostname.lower() not in allowed_hosts:
+        return "callback_url host not allowed", None
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(parsed.hostname, port, type=socket.SOCK_STREAM)]
+    except socket.gaierror:
+        return "callback_url host cannot be resolved", None
+    if not allowed_hosts:
+        for address in addresses:
+            ip = ipaddress.ip_address(address.split('%')[0])
+            # ::ffff:127.0.0.1 这类映射地址按其中的 ipv4 地址判断
+            ip = getattr(ip, 'ipv4_mapped', None) or ip
+            if not ip.is_global or ip.is_multicast:
+                return "callback_url host not allowed", None
+    return None, addresses[0]
+
+
+def check_callback_url(callback_url):
+    """
+    :return: 回调地址不允许时返回错误信息，允许时返回 None
+    """
+    return resolve_callback_url(callback_url)[0]
+
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    """
+    连接到事先校验过的 ip，Host 头仍然是回调地址中的主机名。
+    """
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout, self.source_address)
+
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """
+    连接到事先校验过的 ip，Host 头、SNI 和证书校验仍然使用回调地址中的主机名。
+    """
+
+    def __init__(self, host, address, **kwargs):
+        self.ssl_context = kwargs.setdefault('context', ssl.create_default_context())
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout, self.source_address)
+        self.sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+
+def post_callback(callback_url, address, body):
+    """
+    把 body 以 JSON POST 到 callback_url，连接的是 resolve_callback_url 校验过的 address。
+    不跟随重定向，否则可以借重定向绕过地址校验，非 2xx 的返回码都按失败处理。
+
+    :return: 返回码
     """
+    parsed = urlparse(callback_url)
+    connection_class = PinnedHTTPSConnection if parsed.scheme == 'https' else PinnedHTTPConnection
+    conn = connection_class(parsed.hostname, address, port=parsed.port, timeout=config.callbackTimeout)
     try:
-        status_conn = sqlite3.connect(DB, check_same_thread=False)
-        with status_conn:
-            status_conn.execute('UPDATE tasks SET status=? WHERE id=?', (status, task_id))
-        logger.info(f"任务 {task_id} 的状态更新为 {status}")
+        path = (parsed.path or '/') + (f'?{parsed.query}' if parsed.query else '')
+        conn.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        resp.read()
+        if not 200 <= resp.status < 300:
+            raise RuntimeError(f"HTTP {resp.status} {resp.reason}")
+        return resp.status
+    finally:
+        conn.close()
+
+
+def callback_sender():
+    """
+    任务结束后向上传时提供的 callback_url 发送 POST 请求，
+    内容为 JSON: {"id": 任务id, "status": 状态, "result": 结果文件名}。
+    由 CALLBACK_WORKERS 个线程并发发送，每次只尝试一次，失败的回调按指数退避延迟后重新入队，
+    不可达的地址不会阻塞其他任务的回调。
+    """
+    while True:
+        callback_url, task_id, status, result, attempt = callbacks.get()
+        try:
+            # 每次发送前重新解析校验，并连接到校验过的地址
+            error, address = resolve_callback_url(callback_url)
+            if error:
+                logger.warning(f"任务 {task_id} 的回调地址不允许: {callback_url}, {error}")
+                continue
+            body = json.dumps({'id': task_id, 'status': status, 'result': result}).encode('utf-8')
+            try:
+                code = post_callback(callback_url, address, body)
+                logger.info(f"任务 {task_id} 回调成功: {callback_url}, 返回码: {code}")
+            except Exception as e:
+                logger.warning(f"任务 {task_id} 第 {attempt + 1} 次回调失败: {callback_url}, 错误: {e}")
+                if attempt < config.callbackRetry:
+                    retry = threading.Timer(2 ** attempt, callbacks.put,
+                                            args=((callback_url, task_id, status, result, attempt + 1),))
+                    retry.daemon = True
+                    retry.start()
+        finally:
+            callbacks.task_done()
+
+
+def claim_task(task_id, worker_name):
+    """
+    原子地认领一个待处理任务，同一个任务只会被一个 worker 认领。
+
+    :param task_id: 要认领的任务ID
+    :param worker_name: 认领任务的 worker 名称
+    :return: 是否认领成功
+    """
+    try:
+        with db_pool.connection() as c:
+            cursor = c.execute('UPDATE tasks SET status=?, worker=?, claimed_at=? WHERE id=? AND status=?',
+                               (TASK_STATUS_RUNNING, worker_name, time.time(), task_id, TASK_STATUS_PENDING))
+        claimed = cursor.rowcount == 1
+        if claimed:
+            logger.info(f"任务 {task_id} 的状态更新为 {TASK_STATUS_RUNNING}")
+        return claimed
     except sqlite3.Error as e:
-        logger.error(f"更新任务 {task_id} 状态时数据库错误: {e}")
+        logger.error(f"认领任务 {task_id} 时数据库错误: {e}")
+        return False
+
+
+class TaskLease:
+    """
+    任务运行期间由后台线程定期刷新 claimed_at，表明认领任务的 worker 还活着。
+    超过 TASK_LEASE_TIMEOUT 秒没有续约的任务由 reclaim_expired_tasks 重新置为待处理。
+    """
 
+    def __init__(self, task_id, worker_name, interval):
+        self.task_id = task_id
+        self.worker_name = worker_name
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._renew, name=f"lease-{task_id}", daemon=True)
+
+    def _renew(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with db_pool.connection() as c:
+                    renewed = c.execute('UPDATE tasks SET claimed_at=? WHERE id=? AND worker=? AND status=?',
+                                        (time.time(), self.task_id, self.worker_name, TASK_STATUS_RUNNING)).rowcount
+            except sqlite3.Error as e:
+                logger.error(f"任务 {self.task_id} 续约时数据库错误: {e}")
+                continue
+            if not renewed:
+                logger.warning(f"任务 {self.task_id} 的租约已经失效，可能已被重新认领")
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def worker_prefix():
+    """
+    本进程 worker 名称的前缀，多个进程共享数据库时线程名会重复，加上主机名和进程号区分。
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:"
 
-def worker():
+
+def reclaim_expired_tasks(own_prefix=None):
+    """
+    把租约过期的运行中任务重新置为待处理，认领它的进程已经退出或卡死。
+    共享数据库的其他进程正在运行的任务会持续续约，不会被重新认领。
+
+    :param own_prefix: 启动时传入本进程的 worker 名称前缀。同一主机上的存活进程不可能与本进程同一个进程号，
+                       以它开头的任务一定属于已经退出的进程（容器重启后进程号通常不变），不必等租约过期
+    :return: 重新置为待处理的任务 [(task_id, photo, audio)]
+    """
+    # 旧版本没有 claimed_at，这些任务按租约已过期处理
+    condition = 'status=? AND (claimed_at IS NULL OR claimed_at<?'
+    params = [TASK_STATUS_RUNNING, time.time() - config.taskLeaseTimeout]
+    if own_prefix:
+        condition += ' OR substr(worker, 1, ?)=?'
+        params += [len(own_prefix), own_prefix]
+    condition += ')'
+    reclaimed = []
+    with db_pool.connection() as c:
+        rows = c.execute(f'SELECT id, photo, audio FROM tasks WHERE {condition} ORDER BY created_at', params).fetchall()
+        for task_id, photo_filename, audio_filename in rows:
+            # 条件更新，多个进程同时回收时每个任务只会被回收一次
+            if c.execute(f'UPDATE tasks SET status=?, worker=NULL, claimed_at=NULL WHERE id=? AND {condition}',
+                         [TASK_STATUS_PENDING, task_id] + params).rowcount:
+                reclaimed.append((task_id, photo_filename, audio_filename))
+    return reclaimed
+
+
+def lease_reaper():
+    """
+    定期回收租约过期的任务并重新放入队列。
+    """
+    while True:
+        time.sleep(config.taskLeaseTimeout / 2)
+        try:
+            reclaimed = reclaim_expired_tasks()
+        except sqlite3.Error as e:
+            logger.error(f"回收过期任务时数据库错误: {e}")
+            continue
+        for task in reclaimed:
+            task_queue.put(task)
+        if reclaimed:
+            logger.info(f"回收了 {len(reclaimed)} 个租约过期的任务")
+
+
+def recover_tasks():
+    """
+    启动时恢复任务：本进程号之前认领的和租约已经过期的运行中任务重新置为待处理，
+    然后把所有待处理任务按创建时间重新放入队列。
+    其他主机或进程号认领、租约还有效的任务可能正在运行，保持不变，过期后由 lease_reaper 回收。
+    """
+    with db_pool.connection() as c:
+        # 旧版本数据库没有记录输入文件，这些任务无法恢复
+        c.execute('UPDATE tasks SET status=? WHERE status IN (?,?) AND (photo IS NULL OR audio IS NULL)',
+                  (TASK_STATUS_FAILED, TASK_STATUS_PENDING, TASK_STATUS_RUNNING))
+    interrupted = len(reclaim_expired_tasks(own_prefix=worker_prefix()))
+    with db_pool.connection() as c:
+        pending = c.execute('SELECT id, photo, audio FROM tasks WHERE status=? ORDER BY created_at',
+                            (TASK_STATUS_PENDING,)).fetchall()
+    for task_id, photo_filename, audio_filename in pending:
+        task_queue.put((task_id, photo_filename, audio_filename))
+    logger.info(f"恢复了 {len(pending)} 个待处理任务，其中 {interrupted} 个在上次退出时被中断")
+
+
+def worker(device=None, cpu_threads=0):
+    base_args, pipeline = load_pipeline(device, cpu_threads)
+    worker_name = worker_prefix() + threading.current_thread().name
     while True:
         task_id, photo_filename, audio_filename = task_queue.get()
+        if not claim_task(task_id, worker_name):
+            logger.info(f"任务 {task_id} 已被其他 worker 认领，跳过")
+            task_queue.task_done()
+            continue
         logger.info(f"开始处理任务: {task_id}")
-        update_task_status(task_id, TASK_STATUS_RUNNING)
         try:
-            base_args = [
-                config.pythonPath, 'inference.py',
-                '--driven_audio',
-                audio_filename,
-                '--source_image',
-                photo_filename
-            ]
-            final_args = base_args + process_st_args(config.stArg)
-            logger.debug(f"sadTalker full command: {final_args}")
-            process = subprocess.run(
-                final_args,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            if process.returncode == 0:
-                output = process.stdout.decode('utf-8')
-                match = re.search(r'./results/\d{4}_\d{2}_\d{2}_\d{2}\.\d{2}\.\d{2}\.mp4\n', output)
-                if match:
-                    result = match.group(0).strip().strip("./results/")
-                    with conn as c:
-                        c.execute('UPDATE tasks SET result=? WHERE id=?', (result, task_id))
-                    update_task_status(task_id, TASK_STATUS_SUCCESS)
-                    logger.info(f"任务成功完成: {task_id}, 结果: {result}")
-                else:
-                    logger.warning(f"任务完成但未找到匹配结果: {task_id}")
-                    update_task_status(task_id, TASK_STATUS_MISSING)
+            task_args = copy.copy(base_args)
+            task_args.driven_audio = audio_filename
+            task_args.source_image = photo_filename
+            logger.debug(f"sadTalker args: {task_args}")
+            # 多个 worker 可能在同一秒内完成，按任务id命名输出避免互相覆盖
+            with TaskLease(task_id, worker_name, config.taskLeaseTimeout / 3):
+                st_result = pipeline.generate(task_args, name=task_id)
+            if st_result:
+                result = os.path.relpath(st_result.video_path, config.resultDir)
+                update_task_status(task_id, TASK_STATUS_SUCCESS, result)
+                timings = ', '.join(f"{stage}: {seconds:.1f}s" for stage, seconds in st_result.timings.items())
+                logger.info(f"任务成功完成: {task_id}, 结果: {result}, 帧数: {st_result.frame_num}, 耗时: {timings}")
             else:
-                logger.error(f"任务失败，返回码: {process.returncode}, 错误信息: {process.stderr.decode('utf-8')}")
-                update_task_status(task_id, TASK_STATUS_FAILED)
+                logger.warning(f"任务完成但未生成结果: {task_id}")
+                update_task_status(task_id, TASK_STATUS_MISSING)
         except Exception as e:
             logger.exception(f"处理任务时出现异常: {task_id},错误: {e}")
             update_task_status(task_id, TASK_STATUS_FAILED)
@@ -241,7 +859,16 @@ if __name__ == '__main__':
     if not os.path.exists(config.uploadDir):
         os.makedirs(config.uploadDir)
 
-    # 启动工作线程
-    threading.Thread(target=worker, daemon=True).start()
+    recover_tasks()
+    threading.Thread(target=status_writer, name="status-writer", daemon=True).start()
+    threading.Thread(target=lease_reaper, name="lease-reaper", daemon=True).start()
+    for i in range(max(1, config.callbackWorkers)):
+        threading.Thread(target=callback_sender, name=f"callback-sender-{i}", daemon=True).start()
+
+    # 启动工作线程池，每个线程持有一份常驻模型
+    worker_devices = get_worker_devices()
+    cpu_threads = config.workerCpuThreads or max(1, (os.cpu_count() or 1) // len(worker_devices))
+    for i, device in enumerate(worker_devices):
+        threading.Thread(target=worker, args=(device, cpu_threads), name=f"worker-{i}", daemon=True).start()
 
     app.run(debug=bool(config.prod), host="0.0.0.0", port=int(config.apiPort))
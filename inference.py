@@ -1,100 +1,21 @@
 from glob import glob
-import shutil
 import torch
-from time import  strftime
 import os, sys, time
 from argparse import ArgumentParser
 
-from src.utils.preprocess import CropAndExtract
-from src.test_audio2coeff import Audio2Coeff  
-from src.facerender.animate import AnimateFromCoeff
-from src.generate_batch import get_data
-from src.generate_facerender_batch import get_facerender_data
-from src.utils.init_path import init_path
+from src.pipeline import SadTalkerPipeline
+from src.utils.videoio import ENCODER_PROFILES
 
 def main(args):
     #torch.backends.cudnn.enabled = False
 
-    pic_path = args.source_image
-    audio_path = args.driven_audio
-    save_dir = os.path.join(args.result_dir, strftime("%Y_%m_%d_%H.%M.%S"))
-    os.makedirs(save_dir, exist_ok=True)
-    pose_style = args.pose_style
-    device = args.device
-    batch_size = args.batch_size
-    input_yaw_list = args.input_yaw
-    input_pitch_list = args.input_pitch
-    input_roll_list = args.input_roll
-    ref_eyeblink = args.ref_eyeblink
-    ref_pose = args.ref_pose
-
     current_root_path = os.path.split(sys.argv[0])[0]
 
-    sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), args.size, args.old_version, args.preprocess)
-
-    #init model
-    preprocess_model = CropAndExtract(sadtalker_paths, device)
-
-    audio_to_coeff = Audio2Coeff(sadtalker_paths,  device)
-    
-    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
-
-    #crop image and extract 3dmm from image
-    first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
-    os.makedirs(first_frame_dir, exist_ok=True)
-    print('3DMM Extraction for source image')
-    first_coeff_path, crop_pic_path, crop_info =  preprocess_model.generate(pic_path, first_frame_dir, args.preprocess,\
-                                                                             source_image_flag=True, pic_size=args.size)
-    if first_coeff_path is None:
-        print("Can't get the coeffs of the input")
-        return
-
-    if ref_eyeblink is not None:
-        ref_eyeblink_videoname = os.path.splitext(os.path.split(ref_eyeblink)[-1])[0]
-        ref_eyeblink_frame_dir = os.path.join(save_dir, ref_eyeblink_videoname)
-        os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
-        print('3DMM Extraction for the reference video providing eye blinking')
-        ref_eyeblink_coeff_path, _, _ =  preprocess_model.generate(ref_eyeblink, ref_eyeblink_frame_dir, args.preprocess, source_image_flag=False)
-    else:
-        ref_eyeblink_coeff_path=None
-
-    if ref_pose is not None:
-        if ref_pose == ref_eyeblink: 
-            ref_pose_coeff_path = ref_eyeblink_coeff_path
-        else:
-            ref_pose_videoname = os.path.splitext(os.path.split(ref_pose)[-1])[0]
-            ref_pose_frame_dir = os.path.join(save_dir, ref_pose_videoname)
-            os.makedirs(ref_pose_frame_dir, exist_ok=True)
-            print('3DMM Extraction for the reference video providing pose')
-            ref_pose_coeff_path, _, _ =  preprocess_model.generate(ref_pose, ref_pose_frame_dir, args.preprocess, source_image_flag=False)
-    else:
-        ref_pose_coeff_path=None
-
-    #audio2ceoff
-    batch = get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still)
-    coeff_path = audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
-
-    # 3dface render
-    if args.face3dvis:
-        from src.face3d.visualize import gen_composed_video
-        gen_composed_video(args, device, first_coeff_path, coeff_path, audio_path, os.path.join(save_dir, '3dface.mp4'))
-    
-    #coeff2video
-    data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, 
-                                batch_size, input_yaw_list, input_pitch_list, input_roll_list,
-                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
-    
-    result = animate_from_coeff.generate(data, save_dir, pic_path, crop_info, \
-                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size)
-    
-    shutil.move(result, save_dir+'.mp4')
-    print('The generated video is named:', save_dir+'.mp4')
-
-    if not args.verbose:
-        shutil.rmtree(save_dir)
-
-    
-if __name__ == '__main__':
+    pipeline = SadTalkerPipeline(args, os.path.join(current_root_path, 'src/config'))
+    pipeline.generate(args)
+
+
+def parse_args(argv=None):
 
     parser = ArgumentParser()  
     parser.add_argument("--driven_audio", default='./examples/driven_audio/bus_chinese.wav', help="path to driven audio")
@@ -105,7 +26,20 @@ if __name__ == '__main__':
     parser.add_argument("--result_dir", default='./results', help="path to output")
     parser.add_argument("--pose_style", type=int, default=0,  help="input pose style from [0, 46)")
     parser.add_argument("--batch_size", type=int, default=2,  help="the batch size of facerender")
+    parser.add_argument("--recon_batch_size", type=int, default=32,  help="the number of frames per batch of the 3dmm reconstruction of the input and reference videos")
+    parser.add_argument("--kp_track_interval", type=int, default=0,  help="run the face detector on every n-th frame of the reference videos and track the face in between, 0 to detect on every frame")
+    parser.add_argument("--render_chunk", type=int, default=None,  help="the number of consecutive frames rendered as one batch, halved on out of memory (default: 32 on gpu, batch_size on cpu)")
+    parser.add_argument("--preprocess_cache_dir", default=None, help="directory of the disk caches of the source image and reference video preprocessing results, shared across runs (default: no cache)")
+    parser.add_argument("--preprocess_cache_size", type=int, default=1024, help="the disk budget of the preprocess cache in MB, least recently used entries are evicted first")
+    parser.add_argument("--ref_cache_size", type=int, default=1024, help="the disk budget in MB of the cached coefficients of the reference videos, stored next to the preprocess cache")
     parser.add_argument("--size", type=int, default=256,  help="the image size of the facerender")
+    parser.add_argument("--paste_blend", type=str, default='seamless', choices=['seamless', 'feather'], help="how the face is pasted back in full mode, feather is much faster than seamless")
+    parser.add_argument("--encoder_profile", type=str, default='default', choices=list(ENCODER_PROFILES), help="encoder settings of the output videos, fast/ultrafast for batch jobs, nvenc for nvidia gpus")
+    parser.add_argument("--video_codec", type=str, default=None, help="override the codec of the encoder profile")
+    parser.add_argument("--video_preset", type=str, default=None, help="override the preset of the encoder profile")
+    parser.add_argument("--video_crf", type=int, default=None, help="override the crf of the encoder profile")
+    parser.add_argument("--video_threads", type=int, default=None, help="override the encoder threads of the encoder profile, 0 for auto")
+    parser.add_argument("--video_pix_fmt", type=str, default=None, help="override the pixel format of the encoder profile")
     parser.add_argument("--expression_scale", type=float, default=1.,  help="the batch size of facerender")
     parser.add_argument('--input_yaw', nargs='+', type=int, default=None, help="the input yaw degree of the user ")
     parser.add_argument('--input_pitch', nargs='+', type=int, default=None, help="the input pitch degree of the user")
@@ -134,12 +68,17 @@ if __name__ == '__main__':
     parser.add_argument('--z_near', type=float, default=5.)
     parser.add_argument('--z_far', type=float, default=15.)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if torch.cuda.is_available() and not args.cpu:
         args.device = "cuda"
     else:
         args.device = "cpu"
 
-    main(args)
+    return args
+
+
+if __name__ == '__main__':
+
+    main(parse_args())
 
@@ -0,0 +1,145 @@
+"""
+Check the upload completion callbacks of api.py against a local HTTP stand-in: the {id, status, result}
+body arrives, a failed callback is retried, a slow callback url does not hold back the other callbacks,
+internal addresses are rejected unless they are in CALLBACK_ALLOWED_HOSTS and the callback is sent to the
+address that was checked, a name that resolves to another address afterwards (DNS rebinding) is not
+resolved again.
+
+    python scripts/callback_check.py
+
+Runs in the environment of api.py, tasks.db is created in a temporary directory.
+"""
+import os, sys, json, time, socket, tempfile, threading
+from queue import Queue, Empty
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+# api.py reads its settings from the environment on import
+os.environ['CALLBACK_ALLOWED_HOSTS'] = '127.0.0.1'
+os.environ['CALLBACK_TIMEOUT'] = '1'
+os.environ['CALLBACK_RETRY'] = '2'
+os.environ['CALLBACK_WORKERS'] = '2'
+os.chdir(tempfile.mkdtemp())
+sys.path.insert(0, ROOT)
+import api
+
+
+received = Queue()
+failed_once = set()
+
+class StandIn(BaseHTTPRequestHandler):
+    """
+    /ok answers 200, /flaky answers 500 to the first request and 200 afterwards,
+    /slow answers after the callback timeout
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path == '/slow':
+            time.sleep(3)
+        elif self.path == '/flaky' and self.path not in failed_once:
+            failed_once.add(self.path)
+            self.send_response(500)
+            self.end_headers()
+            return
+        else:
+            received.put((self.path, body, self.headers['Host']))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def expect(path, task_id, timeout):
+    """
+    Wait for the callback of task_id on path, return its Host header
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            got_path, body, host = received.get(timeout=max(0, deadline - time.time()))
+        except Empty:
+            raise AssertionError('no callback on %s within %.1fs' % (path, timeout))
+        if got_path == path:
+            assert body == {'id': task_id, 'status': api.TASK_STATUS_SUCCESS, 'result': task_id + '.mp4'}, body
+            return host
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+    for i in range(api.config.callbackWorkers):
+        threading.Thread(target=api.callback_sender, name='callback-sender-%d' % i, daemon=True).start()
+
+    def send(path, task_id):
+        api.callbacks.put((base_url + path, task_id, api.TASK_STATUS_SUCCESS, task_id + '.mp4', 0))
+
+    send('/ok', 'task-ok')
+    expect('/ok', 'task-ok', timeout=5)
+    print('callback body: ok')
+
+    send('/flaky', 'task-flaky')
+    expect('/flaky', 'task-flaky', timeout=5)
+    print('retry after a failure: ok')
+
+    # the slow url keeps one sender busy, the other sender still delivers right away
+    send('/slow', 'task-slow')
+    time.sleep(0.2)
+    send('/ok', 'task-after-slow')
+    expect('/ok', 'task-after-slow', timeout=0.5)
+    print('slow url does not hold back the others: ok')
+
+    assert api.check_callback_url(base_url + '/ok') is None
+    for url in ['ftp://127.0.0.1/', 'http://localhost/', 'http://169.254.169.254/latest/meta-data']:
+        assert api.check_callback_url(url) is not None, url
+    api.config.callbackAllowedHosts = ''
+    for url in [base_url + '/ok', 'http://10.0.0.1/', 'http://192.168.1.1/', 'http://[::1]/', 'http://[::ffff:127.0.0.1]/']:
+        assert api.check_callback_url(url) is not None, url
+    assert api.check_callback_url('http://8.8.8.8/hook') is None
+    print('internal addresses rejected: ok')
+
+    # the connection goes to the pinned address, the url's host name is only sent as the Host header.
+    # .invalid never resolves, the callback can only arrive through the pinned 127.0.0.1
+    body = json.dumps({'id': 'task-pinned', 'status': api.TASK_STATUS_SUCCESS, 'result': 'task-pinned.mp4'}).encode('utf-8')
+    api.post_callback('http://callback.invalid:%d/ok' % server.server_port, '127.0.0.1', body)
+    host = expect('/ok', 'task-pinned', timeout=1)
+    assert host == 'callback.invalid:%d' % server.server_port, host
+    print('connect to the pinned address: ok')
+
+    # DNS rebinding: rebind.test resolves to a public address for the check and to 127.0.0.1 afterwards
+    getaddrinfo, create_connection = socket.getaddrinfo, socket.create_connection
+    lookups, dialed = [], []
+    def rebinding_getaddrinfo(host, port, *args, **kwargs):
+        if host != 'rebind.test':
+            return getaddrinfo(host, port, *args, **kwargs)
+        lookups.append(host)
+        address = '8.8.8.8' if len(lookups) == 1 else '127.0.0.1'
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, port))]
+    def recording_create_connection(address, *args, **kwargs):
+        dialed.append(address)
+        raise OSError('not dialing out from the check')
+    socket.getaddrinfo, socket.create_connection = rebinding_getaddrinfo, recording_create_connection
+    try:
+        url = 'http://rebind.test:%d/ok' % server.server_port
+        error, address = api.resolve_callback_url(url)
+        assert error is None and address == '8.8.8.8', (error, address)
+        try:
+            api.post_callback(url, address, body)
+            raise AssertionError('the rebinding callback was sent')
+        except OSError:
+            pass
+    finally:
+        socket.getaddrinfo, socket.create_connection = getaddrinfo, create_connection
+    assert lookups == ['rebind.test'], lookups
+    assert dialed == [('8.8.8.8', server.server_port)], dialed
+    assert received.empty()
+    print('no second lookup after the check (DNS rebinding): ok')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Compare the encode time and the file size of the encoder profiles on the same frames.
+
+    python scripts/encoder_benchmark.py --input results/xxx.mp4
+    python scripts/encoder_benchmark.py --input results/xxx.mp4 --profiles default fast ultrafast --repeat 3
+
+Without --input a synthetic clip is encoded, which only makes sense for a rough comparison.
+"""
+import os, sys, time, tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from src.utils.videoio import ENCODER_PROFILES, get_encoder_profile, load_video_to_cv2, save_video
+
+
+def synthetic_frames(frame_num, size):
+    yy, xx = np.mgrid[0:size, 0:size]
+    frames = []
+    for i in range(frame_num):
+        frame = np.stack([(xx + i * 4) % 256, (yy + i * 2) % 256, (xx + yy + i) % 256], axis=-1)
+        frames.append(frame.astype(np.uint8))
+    return frames
+
+
+def main(args):
+    if args.input is not None:
+        frames = list(load_video_to_cv2(args.input, max_frames=args.frame_num))
+    else:
+        frames = synthetic_frames(args.frame_num, args.size)
+    print('%d frames of %dx%d' % (len(frames), frames[0].shape[1], frames[0].shape[0]))
+    print('%-12s %-12s %-10s %12s %12s %10s' % ('profile', 'codec', 'preset', 'time (s)', 'fps', 'size (KB)'))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in args.profiles:
+            encoder = get_encoder_profile(name, threads=args.threads)
+            save_path = os.path.join(tmp_dir, name + '.mp4')
+            try:
+                elapsed = []
+                for _ in range(args.repeat):
+                    start = time.time()
+                    save_video(frames, save_path, fps=25, encoder=encoder)
+                    elapsed.append(time.time() - start)
+            except (RuntimeError, BrokenPipeError) as e:
+                print('%-12s failed: %s' % (name, e))
+                continue
+            best = min(elapsed)
+            print('%-12s %-12s %-10s %12.3f %12.1f %10.1f' % (name, encoder['codec'], encoder['preset'], best,
+                                                             len(frames) / best, os.path.getsize(save_path) / 1024))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--input", default=None, help="video to take the frames from, e.g. a generated result")
+    parser.add_argument("--frame_num", type=int, default=250, help="the number of frames to encode")
+    parser.add_argument("--size", type=int, default=256, help="the size of the synthetic frames")
+    parser.add_argument("--profiles", nargs='+', default=[p for p in ENCODER_PROFILES if p != 'nvenc'], choices=list(ENCODER_PROFILES))
+    parser.add_argument("--threads", type=int, default=None, help="override the encoder threads of every profile")
+    parser.add_argument("--repeat", type=int, default=1, help="encode every profile several times and keep the best time")
+    main(parser.parse_args())
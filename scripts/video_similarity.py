@@ -0,0 +1,40 @@
+"""
+Compare two videos frame by frame with SSIM and PSNR, e.g. the full mode result of --paste_blend seamless
+against the same job with --paste_blend feather.
+
+    python scripts/video_similarity.py results/seamless_full.mp4 results/feather_full.mp4
+"""
+import os, sys
+from argparse import ArgumentParser
+
+import numpy as np
+from skimage.metrics import structural_similarity, peak_signal_noise_ratio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from src.utils.videoio import load_video_to_cv2
+
+
+def main(args):
+    reference = load_video_to_cv2(args.reference)
+    candidate = load_video_to_cv2(args.candidate)
+    if len(reference) != len(candidate):
+        print('Warning: %d frames against %d frames, only the first %d are compared' % (len(reference), len(candidate), min(len(reference), len(candidate))))
+
+    ssim, psnr = [], []
+    for ref, cand in zip(reference, candidate):
+        if ref.shape != cand.shape:
+            raise ValueError('frame size differs: %s against %s' % (ref.shape, cand.shape))
+        ssim.append(structural_similarity(ref, cand, channel_axis=2))
+        psnr.append(peak_signal_noise_ratio(ref, cand))
+    psnr = np.minimum(psnr, 100)
+
+    print('frames: %d' % len(ssim))
+    print('ssim  mean %.4f  min %.4f' % (np.mean(ssim), np.min(ssim)))
+    print('psnr  mean %.2f  min %.2f' % (np.mean(psnr), np.min(psnr)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("reference", help="the reference video")
+    parser.add_argument("candidate", help="the video to compare against the reference")
+    main(parser.parse_args())
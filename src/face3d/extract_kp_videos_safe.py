@@ -1,13 +1,12 @@
 import os
 import cv2
-import time
 import glob
 import argparse
 import numpy as np
 from PIL import Image
 import torch
 from tqdm import tqdm
-from itertools import cycle
+from itertools import cycle, chain
 from torch.multiprocessing import Pool, Process, set_start_method
 
 from facexlib.alignment import landmark_98_to_68
@@ -15,6 +14,7 @@ from facexlib.detection import init_detection_model
 
 from facexlib.utils import load_file_from_url
 from src.face3d.util.my_awing_arch import FAN
+from src.utils.videoio import FrameReader
 
 def init_alignment_model(model_name, half=False, device='cuda', model_rootpath=None):
     if model_name == 'awing_fan':
@@ -32,7 +32,7 @@ def init_alignment_model(model_name, half=False, device='cuda', model_rootpath=N
 
 
 class KeypointExtractor():
-    def __init__(self, device='cuda'):
+    def __init__(self, device='cuda', batch_size=16, track_threshold=0.8):
 
         ### gfpgan/weights
         try:
@@ -44,73 +44,178 @@ class KeypointExtractor():
 
         self.detector = init_alignment_model('awing_fan',device=device, model_rootpath=root_path)   
         self.det_net = init_detection_model('retinaface_resnet50', half=False,device=device, model_rootpath=root_path)
+        # images per detection/landmark batch, halved on out of memory
+        self.batch_size = batch_size
+        # tracking mode: detect again when the landmark confidence drops below this ratio of the keyframe
+        self.track_threshold = track_threshold
+        self.track = None
 
-    def extract_keypoint(self, images, name=None, info=True):
-        if isinstance(images, list):
+    def detect_boxes(self, images):
+        """
+        Face boxes (x1, y1, x2, y2) of a batch of RGB numpy images, None if no face is detected
+        """
+        # the detector takes BGR float32 frames
+        frames = [cv2.cvtColor(image, cv2.COLOR_RGB2BGR).astype(np.float32) for image in images]
+        if all(frame.shape == frames[0].shape for frame in frames):
+            bboxes_list, _ = self.det_net.batched_detect_faces(torch.from_numpy(np.stack(frames)), 0.97)
+        else:
+            bboxes_list = [self.det_net.detect_faces(frame, 0.97) for frame in frames]
+        return [bboxes[0][:4] if len(bboxes) > 0 else None for bboxes in bboxes_list]
+
+    def landmarks(self, images, boxes):
+        """
+        98 landmarks in image coordinates and their confidence for every image with a box, None otherwise
+        """
+        crops, offsets = [], []
+        for image, box in zip(images, boxes):
+            if box is not None:
+                crops.append(image[int(box[1]):int(box[3]), int(box[0]):int(box[2]), :])
+                offsets.append((int(box[0]), int(box[1])))
+        if not crops:
+            return [None] * len(images), [0.] * len(images)
+        preds, scores = self.detector.get_landmarks_batch(crops, return_scores=True)
+
+        found = iter(zip(preds, scores, offsets))
+        landmarks, confidences = [], []
+        for box in boxes:
+            if box is None:
+                landmarks.append(None)
+                confidences.append(0.)
+                continue
+            pred, score, offset = next(found)
+            #### keypoints to the original location
+            pred[:, 0] += offset[0]
+            pred[:, 1] += offset[1]
+            landmarks.append(pred)
+            confidences.append(score)
+        return landmarks, confidences
+
+    def to_keypoints(self, landmarks):
+        if landmarks is None:
+            print('No face detected in this image')
+            return -1. * np.ones([68, 2])
+        return landmark_98_to_68(landmarks)
+
+    def detect_batch(self, images):
+        """
+        Face detection and landmarks of a batch of RGB images (PIL or numpy), return a (68, 2) array
+        per image, all -1 if no face is detected
+        """
+        images = [np.array(image) for image in images]
+        with torch.no_grad():
+            boxes = self.detect_boxes(images)
+            landmarks, _ = self.landmarks(images, boxes)
+        return [self.to_keypoints(lm) for lm in landmarks]
+
+    def track_box(self, landmarks, shape):
+        """
+        Box of the next frame from the landmarks of this frame, framed like the detector box of the last keyframe
+        """
+        x1, y1 = landmarks.min(0)
+        x2, y2 = landmarks.max(0)
+        w, h = max(x2 - x1, 1), max(y2 - y1, 1)
+        rx1, ry1, rx2, ry2 = self.track['relative_box']
+        box = np.array([x1 + rx1 * w, y1 + ry1 * h, x2 + rx2 * w, y2 + ry2 * h])
+        box = np.clip(box, 0, [shape[1], shape[0], shape[1], shape[0]])
+        if box[2] - box[0] < 2 or box[3] - box[1] < 2:
+            return None
+        return box
+
+    def track_frame(self, image, track_interval):
+        """
+        Tracking mode: the detector only runs on every track_interval-th frame, when the landmark confidence
+        drops below track_threshold times the confidence of the last keyframe, or when there is no track.
+        The other boxes come from the landmarks of the previous frame.
+        """
+        image = np.array(image)
+        with torch.no_grad():
+            if self.track is not None and self.track['age'] < track_interval:
+                box = self.track_box(self.track['landmarks'], image.shape)
+                if box is not None:
+                    (landmarks,), (score,) = self.landmarks([image], [box])
+                    if score >= self.track_threshold * self.track['score']:
+                        self.track['landmarks'] = landmarks
+                        self.track['age'] += 1
+                        return self.to_keypoints(landmarks)
+                # the track is lost, detect again
+
+            (box,) = self.detect_boxes([image])
+            (landmarks,), (score,) = self.landmarks([image], [box])
+        if landmarks is None:
+            self.track = None
+        else:
+            x1, y1 = landmarks.min(0)
+            x2, y2 = landmarks.max(0)
+            w, h = max(x2 - x1, 1), max(y2 - y1, 1)
+            # the detector box relative to the landmark extent
+            relative_box = ((box[0] - x1) / w, (box[1] - y1) / h, (box[2] - x2) / w, (box[3] - y2) / h)
+            self.track = {'landmarks': landmarks, 'score': score, 'age': 1, 'relative_box': relative_box}
+        return self.to_keypoints(landmarks)
+
+    def detect_with_backoff(self, images):
+        """
+        detect_batch that splits the batch in halves on out of memory, the smaller batch size is kept
+        for the following batches
+        """
+        try:
+            return self.detect_batch(images)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e) or len(images) == 1:
+                raise
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self.batch_size = min(self.batch_size, max(1, len(images) // 2))
+        print("Warning: out of memory, reduce the landmark batch to %d images" % self.batch_size)
+        half = len(images) // 2
+        return self.detect_with_backoff(images[:half]) + self.detect_with_backoff(images[half:])
+
+    def extract_keypoint(self, images, name=None, info=True, track_interval=0):
+        """
+        track_interval: for a list of frames, run the face detector only every track_interval frames (see
+        track_frame) instead of on every frame, 0 to disable tracking
+        """
+        if isinstance(images, (list, FrameReader)):
             keypoints = []
-            if info:
-                i_range = tqdm(images,desc='landmark Det:')
-            else:
-                i_range = images
+            progress = tqdm(total=len(images), desc='landmark Det:', disable=not info)
 
-            for image in i_range:
-                current_kp = self.extract_keypoint(image)
-                # current_kp = self.detector.get_landmarks(np.array(image))
+            def append(current_kp):
                 if np.mean(current_kp) == -1 and keypoints:
                     keypoints.append(keypoints[-1])
                 else:
                     keypoints.append(current_kp[None])
 
+            if track_interval > 0:
+                self.track = None
+                for image in images:
+                    append(self.track_frame(image, track_interval))
+                    progress.update(1)
+            else:
+                batch = []
+                for image in chain(images, [None]):
+                    if image is not None:
+                        batch.append(image)
+                        if len(batch) < self.batch_size:
+                            continue
+                    if not batch:
+                        break
+                    for current_kp in self.detect_with_backoff(batch):
+                        append(current_kp)
+                    progress.update(len(batch))
+                    batch = []
+            progress.close()
+
             keypoints = np.concatenate(keypoints, 0)
             np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
         else:
-            while True:
-                try:
-                    with torch.no_grad():
-                        # face detection -> face alignment.
-                        img = np.array(images)
-                        bboxes = self.det_net.detect_faces(images, 0.97)
-                        
-                        bboxes = bboxes[0]
-                        img = img[int(bboxes[1]):int(bboxes[3]), int(bboxes[0]):int(bboxes[2]), :]
-
-                        keypoints = landmark_98_to_68(self.detector.get_landmarks(img)) # [0]
-
-                        #### keypoints to the original location
-                        keypoints[:,0] += int(bboxes[0])
-                        keypoints[:,1] += int(bboxes[1])
-
-                        break
-                except RuntimeError as e:
-                    if str(e).startswith('CUDA'):
-                        print("Warning: out of memory, sleep for 1s")
-                        time.sleep(1)
-                    else:
-                        print(e)
-                        break    
-                except TypeError:
-                    print('No face detected in this image')
-                    shape = [68, 2]
-                    keypoints = -1. * np.ones(shape)                    
-                    break
+            keypoints = self.detect_with_backoff([images])[0]
             if name is not None:
                 np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
 
 def read_video(filename):
-    frames = []
-    cap = cv2.VideoCapture(filename)
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = Image.fromarray(frame)
-            frames.append(frame)
-        else:
-            break
-    cap.release()
-    return frames
+    # RGB frames, decoded while the keypoints are extracted
+    return FrameReader(filename, rgb=True)
 
 def run(data):
     filename, opt, device = data
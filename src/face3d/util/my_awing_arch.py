@@ -376,3 +376,28 @@ class FAN(nn.Module):
         pred += offset[-2:]
 
         return pred
+
+    def get_landmarks_batch(self, imgs, return_scores=False):
+        """
+        get_landmarks of a list of RGB crops (of any size) with a single forward pass
+        return_scores: also return the mean heatmap peak of every crop, a confidence of the landmarks
+        """
+        inp = np.stack([cv2.resize(img, (256, 256))[..., ::-1] for img in imgs])
+        inp = torch.from_numpy(np.ascontiguousarray(inp.transpose((0, 3, 1, 2)))).float()
+        inp = inp.to(self.device)
+        inp.div_(255.0)
+
+        outputs, _ = self.forward(inp)
+        out = outputs[-1][:, :-1, :, :]
+        heatmaps = out.detach().cpu().numpy()
+
+        preds = []
+        for img, heatmap in zip(imgs, heatmaps):
+            H, W, _ = img.shape
+            # one sample at a time, the border handling of calculate_points is decided per batch
+            pred = calculate_points(heatmap[None]).reshape(-1, 2)
+            pred *= (W / 64, H / 64)
+            preds.append(pred)
+        if return_scores:
+            return preds, list(heatmaps.max(axis=(2, 3)).mean(axis=1))
+        return preds
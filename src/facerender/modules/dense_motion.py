@@ -1,7 +1,7 @@
 from torch import nn
 import torch.nn.functional as F
 import torch
-from src.facerender.modules.util import Hourglass, make_coordinate_grid, kp2gaussian
+from src.facerender.modules.util import Hourglass, make_coordinate_grid, kp2gaussian, grid_sample_shared
 
 from src.facerender.sync_batchnorm import SynchronizedBatchNorm3d as BatchNorm3d
 
@@ -29,11 +29,20 @@ class DenseMotionNetwork(nn.Module):
             self.occlusion = None
 
         self.num_kp = num_kp
+        # identity grids keyed by (spatial size, dtype, device)
+        self.identity_grids = {}
 
+    def get_identity_grid(self, spatial_size, ref):
+        key = (tuple(spatial_size), ref.dtype, ref.device)
+        if key not in self.identity_grids:
+            self.identity_grids[key] = make_coordinate_grid(spatial_size, type=ref.type()).to(ref.device)
+        return self.identity_grids[key]
 
     def create_sparse_motions(self, feature, kp_driving, kp_source):
-        bs, _, d, h, w = feature.shape
-        identity_grid = make_coordinate_grid((d, h, w), type=kp_source['value'].type())
+        _, _, d, h, w = feature.shape
+        # the source may be a single image shared by a batch of driving frames
+        bs = kp_driving['value'].shape[0]
+        identity_grid = self.get_identity_grid((d, h, w), kp_source['value'])
         identity_grid = identity_grid.view(1, 1, d, h, w, 3)
         coordinate_grid = identity_grid - kp_driving['value'].view(bs, self.num_kp, 1, 1, 1, 3)
         
@@ -46,10 +55,10 @@ class DenseMotionNetwork(nn.Module):
             coordinate_grid = coordinate_grid.squeeze(-1)                  
 
 
-        driving_to_source = coordinate_grid + kp_source['value'].view(bs, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3)
+        driving_to_source = coordinate_grid + kp_source['value'].view(-1, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3)
 
         #adding background feature
-        identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1, 1)
+        identity_grid = identity_grid.expand(bs, 1, d, h, w, 3)
         sparse_motions = torch.cat([identity_grid, driving_to_source], dim=1)                #bs num_kp+1 d h w 3
         
         # sparse_motions = driving_to_source
@@ -57,18 +66,25 @@ class DenseMotionNetwork(nn.Module):
         return sparse_motions
 
     def create_deformed_feature(self, feature, sparse_motions):
-        bs, _, d, h, w = feature.shape
-        feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)      # (bs, num_kp+1, 1, c, d, h, w)
-        feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)                         # (bs*(num_kp+1), c, d, h, w)
+        _, _, d, h, w = feature.shape
+        bs = sparse_motions.shape[0]
         sparse_motions = sparse_motions.view((bs * (self.num_kp+1), d, h, w, -1))                       # (bs*(num_kp+1), d, h, w, 3) !!!!
-        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
-        sparse_deformed = sparse_deformed.view((bs, self.num_kp+1, -1, d, h, w))                        # (bs, num_kp+1, c, d, h, w)
+        if feature.shape[0] == 1:
+            # one source feature for every keypoint of every frame, sample it without repeating it
+            sparse_deformed = grid_sample_shared(feature, sparse_motions)
+        else:
+            feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)      # (bs, num_kp+1, 1, c, d, h, w)
+            feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)                         # (bs*(num_kp+1), c, d, h, w)
+            sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
+        sparse_deformed = sparse_deformed.reshape((bs, self.num_kp+1, -1, d, h, w))                     # (bs, num_kp+1, c, d, h, w)
         return sparse_deformed
 
-    def create_heatmap_representations(self, feature, kp_driving, kp_source):
+    def create_heatmap_representations(self, feature, kp_driving, kp_source, gaussian_source=None):
         spatial_size = feature.shape[3:]
-        gaussian_driving = kp2gaussian(kp_driving, spatial_size=spatial_size, kp_variance=0.01)
-        gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01)
+        coordinate_grid = self.get_identity_grid(spatial_size, kp_driving['value'])
+        gaussian_driving = kp2gaussian(kp_driving, spatial_size=spatial_size, kp_variance=0.01, coordinate_grid=coordinate_grid)
+        if gaussian_source is None:
+            gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01, coordinate_grid=coordinate_grid)
         heatmap = gaussian_driving - gaussian_source
 
         # adding background feature
@@ -77,18 +93,35 @@ class DenseMotionNetwork(nn.Module):
         heatmap = heatmap.unsqueeze(2)         # (bs, num_kp+1, 1, d, h, w)
         return heatmap
 
-    def forward(self, feature, kp_driving, kp_source):
-        bs, _, d, h, w = feature.shape
-
+    def prepare_source(self, feature, kp_source):
+        """
+        Precompute everything that only depends on the source: the compressed feature and the
+        source keypoint heatmaps. Pass the result to `forward` as `source` to skip this work for
+        every frame of the same video. A single source (batch 1) can drive a batch of frames.
+        """
         feature = self.compress(feature)
         feature = self.norm(feature)
         feature = F.relu(feature)
 
+        spatial_size = feature.shape[2:]
+        coordinate_grid = self.get_identity_grid(spatial_size, kp_source['value'])
+        gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01, coordinate_grid=coordinate_grid)
+
+        return {'feature': feature, 'gaussian_source': gaussian_source}
+
+    def forward(self, feature, kp_driving, kp_source, source=None):
+        _, _, d, h, w = feature.shape
+        bs = kp_driving['value'].shape[0]
+
+        if source is None:
+            source = self.prepare_source(feature, kp_source)
+        feature = source['feature']
+
         out_dict = dict()
         sparse_motion = self.create_sparse_motions(feature, kp_driving, kp_source)
         deformed_feature = self.create_deformed_feature(feature, sparse_motion)
 
-        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source)
+        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source, source['gaussian_source'])
 
         input_ = torch.cat([heatmap, deformed_feature], dim=2)
         input_ = input_.view(bs, -1, d, h, w)
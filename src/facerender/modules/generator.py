@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from src.facerender.modules.util import ResBlock2d, SameBlock2d, UpBlock2d, DownBlock2d, ResBlock3d, SPADEResnetBlock
+from src.facerender.modules.util import ResBlock2d, SameBlock2d, UpBlock2d, DownBlock2d, ResBlock3d, SPADEResnetBlock, grid_sample_shared
 from src.facerender.modules.dense_motion import DenseMotionNetwork
 
 
@@ -65,9 +65,15 @@ class OcclusionAwareGenerator(nn.Module):
             deformation = deformation.permute(0, 4, 1, 2, 3)
             deformation = F.interpolate(deformation, size=(d, h, w), mode='trilinear')
             deformation = deformation.permute(0, 2, 3, 4, 1)
+        if inp.shape[0] == 1 and deformation.shape[0] > 1:
+            return grid_sample_shared(inp, deformation)
         return F.grid_sample(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
+    def encode_source(self, source_image):
+        """
+        Encode the source image into the 3d feature volume, it only depends on the source image
+        so it can be computed once per video and reused by `animate` for every frame.
+        """
         # Encoding (downsampling) part
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
@@ -77,12 +83,26 @@ class OcclusionAwareGenerator(nn.Module):
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
         feature_3d = self.resblocks_3d(feature_3d)
+        return feature_3d
+
+    def prepare_motion(self, feature_3d, kp_source):
+        """
+        Precompute the source-only part of the dense motion estimation, see DenseMotionNetwork.prepare_source.
+        """
+        if self.dense_motion_network is None:
+            return None
+        return self.dense_motion_network.prepare_source(feature_3d, kp_source)
+
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.animate(feature_3d, kp_driving, kp_source)
 
+    def animate(self, feature_3d, kp_driving, kp_source, source_motion=None):
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
         if self.dense_motion_network is not None:
             dense_motion = self.dense_motion_network(feature=feature_3d, kp_driving=kp_driving,
-                                                     kp_source=kp_source)
+                                                     kp_source=kp_source, source=source_motion)
             output_dict['mask'] = dense_motion['mask']
 
             if 'occlusion_map' in dense_motion:
@@ -94,7 +114,7 @@ class OcclusionAwareGenerator(nn.Module):
             out = self.deform_input(feature_3d, deformation)
 
             bs, c, d, h, w = out.shape
-            out = out.view(bs, c*d, h, w)
+            out = out.reshape(bs, c*d, h, w)
             out = self.third(out)
             out = self.fourth(out)
 
@@ -205,9 +225,15 @@ class OcclusionAwareSPADEGenerator(nn.Module):
             deformation = deformation.permute(0, 4, 1, 2, 3)
             deformation = F.interpolate(deformation, size=(d, h, w), mode='trilinear')
             deformation = deformation.permute(0, 2, 3, 4, 1)
+        if inp.shape[0] == 1 and deformation.shape[0] > 1:
+            return grid_sample_shared(inp, deformation)
         return F.grid_sample(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
+    def encode_source(self, source_image):
+        """
+        Encode the source image into the 3d feature volume, it only depends on the source image
+        so it can be computed once per video and reused by `animate` for every frame.
+        """
         # Encoding (downsampling) part
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
@@ -217,12 +243,26 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
         feature_3d = self.resblocks_3d(feature_3d)
+        return feature_3d
+
+    def prepare_motion(self, feature_3d, kp_source):
+        """
+        Precompute the source-only part of the dense motion estimation, see DenseMotionNetwork.prepare_source.
+        """
+        if self.dense_motion_network is None:
+            return None
+        return self.dense_motion_network.prepare_source(feature_3d, kp_source)
+
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.animate(feature_3d, kp_driving, kp_source)
 
+    def animate(self, feature_3d, kp_driving, kp_source, source_motion=None):
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
         if self.dense_motion_network is not None:
             dense_motion = self.dense_motion_network(feature=feature_3d, kp_driving=kp_driving,
-                                                     kp_source=kp_source)
+                                                     kp_source=kp_source, source=source_motion)
             output_dict['mask'] = dense_motion['mask']
 
             # import pdb; pdb.set_trace()
@@ -236,7 +276,7 @@ class OcclusionAwareSPADEGenerator(nn.Module):
             out = self.deform_input(feature_3d, deformation)
 
             bs, c, d, h, w = out.shape
-            out = out.view(bs, c*d, h, w)
+            out = out.reshape(bs, c*d, h, w)
             out = self.third(out)
             out = self.fourth(out)
 
@@ -99,44 +99,104 @@ def keypoint_transformation(kp_canonical, he, wo_exp=False):
 
 
 
-def make_animation(source_image, source_semantics, target_semantics,
+def default_chunk_size(device, batch_size):
+    # the generator is one batched pass per chunk, on gpu start large and let
+    # make_animation halve the chunk on out of memory
+    if torch.device(device).type == 'cuda':
+        return 32
+    return batch_size
+
+def driving_keypoints(kp_canonical, target_semantics, mapping, yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None):
+    """
+    Head pose/expression prediction and keypoint transformation for a whole sequence in one
+    batched call, target_semantics: (frames, 70, 27), the c_seq: (frames,)
+    """
+    he_driving = mapping(target_semantics)
+    if yaw_c_seq is not None:
+        he_driving['yaw_in'] = yaw_c_seq
+    if pitch_c_seq is not None:
+        he_driving['pitch_in'] = pitch_c_seq
+    if roll_c_seq is not None:
+        he_driving['roll_in'] = roll_c_seq
+
+    kp_canonical = {'value': kp_canonical['value'].expand(target_semantics.shape[0], -1, -1)}
+    return keypoint_transformation(kp_canonical, he_driving)
+
+@torch.no_grad()
+def render_animation(source_image, source_semantics, target_semantics,
                             generator, kp_detector, he_estimator, mapping, 
                             yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
-                            use_exp=True, use_half=False):
-    with torch.no_grad():
-        predictions = []
+                            use_exp=True, use_half=False, frame_num=None, chunk_size=None):
+    """
+    Generator version of make_animation, yield the rendered chunks (chunk_size, 3, H, W) in temporal
+    order as soon as they are ready so that the caller never holds the whole video.
+
+    target_semantics is laid out as (batch_size, T/batch_size, ...) by get_facerender_data, flattening
+    the first two axes gives back the frames in temporal order. The driving keypoints of all frames are
+    computed in one batch, then the frames are rendered in chunks of `chunk_size` consecutive frames,
+    the chunk is halved whenever it runs out of memory.
+    frame_num: only render the first frame_num frames, the rest is batch padding
+    """
+    # every row of the source is the same image, the generator broadcasts a single source over a chunk
+    source_image = source_image[:1]
+    source_semantics = source_semantics[:1]
+    kp_canonical = kp_detector(source_image)
+    he_source = mapping(source_semantics)
+    kp_source = keypoint_transformation(kp_canonical, he_source)
+    # the source image is the same for every frame, encode it only once
+    source_feature = generator.encode_source(source_image)
+    source_motion = generator.prepare_motion(source_feature, kp_source)
+
+    batch_size = target_semantics.shape[0]
+    target_semantics = target_semantics.reshape((-1,) + target_semantics.shape[2:])
+    if frame_num is None:
+        frame_num = target_semantics.shape[0]
+    target_semantics = target_semantics[:frame_num]
+    if yaw_c_seq is not None:
+        yaw_c_seq = yaw_c_seq.reshape(-1)[:frame_num]
+    if pitch_c_seq is not None:
+        pitch_c_seq = pitch_c_seq.reshape(-1)[:frame_num]
+    if roll_c_seq is not None:
+        roll_c_seq = roll_c_seq.reshape(-1)[:frame_num]
+
+    # the driving keypoints of every frame up front, the render loop only runs the generator
+    kp_driving = driving_keypoints(kp_canonical, target_semantics, mapping,
+                                    yaw_c_seq=yaw_c_seq, pitch_c_seq=pitch_c_seq, roll_c_seq=roll_c_seq)
+    if chunk_size is None:
+        chunk_size = default_chunk_size(source_image.device, batch_size)
+
+    progress = tqdm(total=frame_num, desc='Face Renderer:')
+    start = 0
+    while start < frame_num:
+        end = min(start + chunk_size, frame_num)
+        try:
+            out = generator.animate(source_feature, kp_source=kp_source,
+                                    kp_driving={'value': kp_driving['value'][start:end]}, source_motion=source_motion)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e) or chunk_size == 1:
+                raise
+            chunk_size = chunk_size // 2
+            print('Warning: out of memory, reduce the render chunk to %d frames' % chunk_size)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            continue
+        yield out['prediction']
+        progress.update(end - start)
+        start = end
+    progress.close()
 
-        kp_canonical = kp_detector(source_image)
-        he_source = mapping(source_semantics)
-        kp_source = keypoint_transformation(kp_canonical, he_source)
-    
-        for frame_idx in tqdm(range(target_semantics.shape[1]), 'Face Renderer:'):
-            # still check the dimension
-            # print(target_semantics.shape, source_semantics.shape)
-            target_semantics_frame = target_semantics[:, frame_idx]
-            he_driving = mapping(target_semantics_frame)
-            if yaw_c_seq is not None:
-                he_driving['yaw_in'] = yaw_c_seq[:, frame_idx]
-            if pitch_c_seq is not None:
-                he_driving['pitch_in'] = pitch_c_seq[:, frame_idx] 
-            if roll_c_seq is not None:
-                he_driving['roll_in'] = roll_c_seq[:, frame_idx] 
-            
-            kp_driving = keypoint_transformation(kp_canonical, he_driving)
-                
-            kp_norm = kp_driving
-            out = generator(source_image, kp_source=kp_source, kp_driving=kp_norm)
-            '''
-            source_image_new = out['prediction'].squeeze(1)
-            kp_canonical_new =  kp_detector(source_image_new)
-            he_source_new = he_estimator(source_image_new) 
-            kp_source_new = keypoint_transformation(kp_canonical_new, he_source_new, wo_exp=True)
-            kp_driving_new = keypoint_transformation(kp_canonical_new, he_driving, wo_exp=True)
-            out = generator(source_image_new, kp_source=kp_source_new, kp_driving=kp_driving_new)
-            '''
-            predictions.append(out['prediction'])
-        predictions_ts = torch.stack(predictions, dim=1)
-    return predictions_ts
+def make_animation(source_image, source_semantics, target_semantics,
+                            generator, kp_detector, he_estimator, mapping, 
+                            yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
+                            use_exp=True, use_half=False, frame_num=None, chunk_size=None):
+    """
+    Return the whole video at once in temporal order, (frame_num, 3, H, W), see render_animation
+    """
+    predictions = render_animation(source_image, source_semantics, target_semantics,
+                                    generator, kp_detector, he_estimator, mapping,
+                                    yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp=use_exp, use_half=use_half,
+                                    frame_num=frame_num, chunk_size=chunk_size)
+    return torch.cat(list(predictions), dim=0)
 
 class AnimateModel(torch.nn.Module):
     """
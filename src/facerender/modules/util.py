@@ -9,18 +9,19 @@ from src.facerender.sync_batchnorm import SynchronizedBatchNorm3d as BatchNorm3d
 import torch.nn.utils.spectral_norm as spectral_norm
 
 
-def kp2gaussian(kp, spatial_size, kp_variance):
+def kp2gaussian(kp, spatial_size, kp_variance, coordinate_grid=None):
     """
     Transform a keypoint into gaussian like representation
+    coordinate_grid: optional precomputed make_coordinate_grid(spatial_size) on the same device as kp
     """
     mean = kp['value']
 
-    coordinate_grid = make_coordinate_grid(spatial_size, mean.type())
+    if coordinate_grid is None:
+        coordinate_grid = make_coordinate_grid(spatial_size, mean.type())
     number_of_leading_dimensions = len(mean.shape) - 1
     shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
+    # broadcast against the keypoints instead of repeating the grid
     coordinate_grid = coordinate_grid.view(*shape)
-    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)
-    coordinate_grid = coordinate_grid.repeat(*repeats)
 
     # Preprocess kp shape
     shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)
@@ -32,6 +33,17 @@ def kp2gaussian(kp, spatial_size, kp_variance):
 
     return out
 
+def grid_sample_shared(inp, grid):
+    """
+    F.grid_sample of a single input (1, c, d, h, w) with a batch of grids (bs, d_out, h_out, w_out, 3)
+    without copying the input bs times: the grids are stacked along depth and sampled in one call.
+    Return (bs, c, d_out, h_out, w_out)
+    """
+    bs, d, h, w, _ = grid.shape
+    out = F.grid_sample(inp, grid.reshape(1, bs * d, h, w, 3))
+    out = out.view(inp.shape[1], bs, d, h, w)
+    return out.transpose(0, 1)
+
 def make_coordinate_grid_2d(spatial_size, type):
     """
     Create a meshgrid [-1,1] x [-1,1] of given spatial_size.
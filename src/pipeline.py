@@ -0,0 +1,173 @@
+import os
+import shutil
+import time
+from time import strftime
+from collections import namedtuple
+
+from src.utils.preprocess import CropAndExtract
+from src.test_audio2coeff import Audio2Coeff
+from src.facerender.animate import AnimateFromCoeff
+from src.generate_batch import get_data
+from src.generate_facerender_batch import get_facerender_data
+from src.utils.init_path import init_path
+from src.utils.videoio import get_encoder_profile
+from src.utils.preprocess_cache import PreprocessCache
+
+
+# video_path: path of the generated video
+# frame_num: number of frames in the video
+# timings: seconds spent in each stage, in the order they ran
+SadTalkerResult = namedtuple('SadTalkerResult', ['video_path', 'frame_num', 'timings'])
+
+
+class SadTalkerPipeline():
+    """
+    Keep the three model stacks resident so that a long-lived process (e.g. api.py)
+    pays the checkpoint loading cost once instead of once per video.
+
+    The models depend on checkpoint_dir/size/old_version/preprocess/device, every
+    other field of `args` may change between calls of `generate`.
+    """
+
+    def __init__(self, args, config_dir=None):
+
+        if config_dir is None:
+            config_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config')
+
+        self.sadtalker_paths = init_path(args.checkpoint_dir, config_dir, args.size, args.old_version, args.preprocess)
+        self.device = args.device
+
+        #init model
+        self.preprocess_model = CropAndExtract(self.sadtalker_paths, self.device)
+
+        self.audio_to_coeff = Audio2Coeff(self.sadtalker_paths, self.device)
+
+        self.animate_from_coeff = AnimateFromCoeff(self.sadtalker_paths, self.device)
+
+        # the source image and reference video results are reused across jobs through disk caches shared by
+        # the processes, the two have their own budget so that new avatars do not evict the stock reference clips
+        self.preprocess_cache = self.ref_cache = None
+        if args.preprocess_cache_dir:
+            self.preprocess_cache = PreprocessCache(os.path.join(args.preprocess_cache_dir, 'source'), max_size=args.preprocess_cache_size * 1024 * 1024)
+            self.ref_cache = PreprocessCache(os.path.join(args.preprocess_cache_dir, 'ref'), max_size=args.ref_cache_size * 1024 * 1024)
+
+    def preprocess(self, input_path, save_dir, crop_or_resize, source_image_flag=False, pic_size=256, **kwargs):
+        """
+        CropAndExtract.generate, served from the preprocess cache when the same file was preprocessed
+        with the same settings before
+        """
+        cache = self.preprocess_cache if source_image_flag else self.ref_cache
+        if cache is None:
+            return self.preprocess_model.generate(input_path, save_dir, crop_or_resize, source_image_flag=source_image_flag, pic_size=pic_size, **kwargs)
+
+        recon_model = self.sadtalker_paths['checkpoint'] if self.sadtalker_paths['use_safetensor'] else self.sadtalker_paths['path_of_net_recon_model']
+        key = cache.key(input_path, crop_or_resize, source_image_flag, pic_size, kwargs.get('kp_track_interval', 0), recon_model)
+        pic_name = os.path.splitext(os.path.split(input_path)[-1])[0]
+        cached = cache.get(key, save_dir, pic_name)
+        if cached is not None:
+            print(' Using the cached 3DMM coefficients of', input_path)
+            return cached
+
+        coeff_path, png_path, crop_info = self.preprocess_model.generate(input_path, save_dir, crop_or_resize, source_image_flag=source_image_flag, pic_size=pic_size, **kwargs)
+        if coeff_path is not None and source_image_flag:
+            cache.put(key, coeff_path, png_path, crop_info, landmarks_path=os.path.join(save_dir, pic_name+'_landmarks.txt'))
+        elif coeff_path is not None:
+            # only the coefficients of a reference video are used later on
+            cache.put(key, coeff_path, None, crop_info)
+        return coeff_path, png_path, crop_info
+
+    def generate(self, args, name=None):
+        """
+        Run one video through the resident models. The video is saved as `<result_dir>/<name>.mp4`,
+        `name` defaults to the current time.
+
+        Return a SadTalkerResult, or None if no face is found in the source image.
+        """
+
+        pic_path = args.source_image
+        audio_path = args.driven_audio
+        if name is None:
+            name = strftime("%Y_%m_%d_%H.%M.%S")
+        save_dir = os.path.join(args.result_dir, name)
+        os.makedirs(save_dir, exist_ok=True)
+        timings = {}
+        stage_start = time.time()
+        pose_style = args.pose_style
+        device = self.device
+        batch_size = args.batch_size
+        input_yaw_list = args.input_yaw
+        input_pitch_list = args.input_pitch
+        input_roll_list = args.input_roll
+        ref_eyeblink = args.ref_eyeblink
+        ref_pose = args.ref_pose
+
+        #crop image and extract 3dmm from image
+        first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
+        os.makedirs(first_frame_dir, exist_ok=True)
+        print('3DMM Extraction for source image')
+        first_coeff_path, crop_pic_path, crop_info =  self.preprocess(pic_path, first_frame_dir, args.preprocess,\
+                                                                                 source_image_flag=True, pic_size=args.size, batch_size=args.recon_batch_size)
+        if first_coeff_path is None:
+            print("Can't get the coeffs of the input")
+            return None
+        timings['preprocess'] = time.time() - stage_start
+        stage_start = time.time()
+
+        if ref_eyeblink is not None:
+            ref_eyeblink_videoname = os.path.splitext(os.path.split(ref_eyeblink)[-1])[0]
+            ref_eyeblink_frame_dir = os.path.join(save_dir, ref_eyeblink_videoname)
+            os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
+            print('3DMM Extraction for the reference video providing eye blinking')
+            ref_eyeblink_coeff_path, _, _ =  self.preprocess(ref_eyeblink, ref_eyeblink_frame_dir, args.preprocess, source_image_flag=False, \
+                                                                             batch_size=args.recon_batch_size, kp_track_interval=args.kp_track_interval)
+        else:
+            ref_eyeblink_coeff_path=None
+
+        if ref_pose is not None:
+            if ref_pose == ref_eyeblink:
+                ref_pose_coeff_path = ref_eyeblink_coeff_path
+            else:
+                ref_pose_videoname = os.path.splitext(os.path.split(ref_pose)[-1])[0]
+                ref_pose_frame_dir = os.path.join(save_dir, ref_pose_videoname)
+                os.makedirs(ref_pose_frame_dir, exist_ok=True)
+                print('3DMM Extraction for the reference video providing pose')
+                ref_pose_coeff_path, _, _ =  self.preprocess(ref_pose, ref_pose_frame_dir, args.preprocess, source_image_flag=False, \
+                                                                             batch_size=args.recon_batch_size, kp_track_interval=args.kp_track_interval)
+        else:
+            ref_pose_coeff_path=None
+        if ref_eyeblink is not None or ref_pose is not None:
+            timings['ref_video'] = time.time() - stage_start
+            stage_start = time.time()
+
+        #audio2ceoff
+        batch = get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still)
+        coeff_path = self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+        timings['audio2coeff'] = time.time() - stage_start
+        stage_start = time.time()
+
+        # 3dface render
+        if args.face3dvis:
+            from src.face3d.visualize import gen_composed_video
+            gen_composed_video(args, device, first_coeff_path, coeff_path, audio_path, os.path.join(save_dir, '3dface.mp4'))
+            timings['face3dvis'] = time.time() - stage_start
+            stage_start = time.time()
+
+        #coeff2video
+        data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path,
+                                    batch_size, input_yaw_list, input_pitch_list, input_roll_list,
+                                    expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
+
+        encoder = get_encoder_profile(args.encoder_profile, codec=args.video_codec, preset=args.video_preset,
+                                      crf=args.video_crf, threads=args.video_threads, pix_fmt=args.video_pix_fmt)
+        result = self.animate_from_coeff.generate(data, save_dir, pic_path, crop_info, \
+                                    enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size, \
+                                    render_chunk=args.render_chunk, encoder=encoder, paste_blend=args.paste_blend)
+        timings['facerender'] = time.time() - stage_start
+
+        shutil.move(result, save_dir+'.mp4')
+        print('The generated video is named:', save_dir+'.mp4')
+
+        if not args.verbose:
+            shutil.rmtree(save_dir)
+
+        return SadTalkerResult(save_dir+'.mp4', data['frame_num'], timings)
@@ -123,22 +123,29 @@ class Preprocesser:
         # Save aligned image.
         return rsize, crop, [lx, ly, rx, ry]
     
-    def crop(self, img_np_list, still=False, xsize=512):    # first frame for all video
-        img_np = img_np_list[0]
+    def crop_params(self, img_np, xsize=512):
+        """
+        Crop parameters of a video computed from its first frame, see apply_crop
+        """
         lm = self.get_landmark(img_np)
 
         if lm is None:
             raise 'can not detect the landmark from source image'
-        rsize, crop, quad = self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+        return self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+
+    def apply_crop(self, img_np, rsize, crop, quad, still=False):
         clx, cly, crx, cry = crop
         lx, ly, rx, ry = quad
         lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
+        _inp = cv2.resize(img_np, (rsize[0], rsize[1]))
+        _inp = _inp[cly:cry, clx:crx]
+        if not still:
+            _inp = _inp[ly:ry, lx:rx]
+        return _inp
+
+    def crop(self, img_np_list, still=False, xsize=512):    # first frame for all video
+        rsize, crop, quad = self.crop_params(img_np_list[0], xsize=xsize)
         for _i in range(len(img_np_list)):
-            _inp = img_np_list[_i]
-            _inp = cv2.resize(_inp, (rsize[0], rsize[1]))
-            _inp = _inp[cly:cry, clx:crx]
-            if not still:
-                _inp = _inp[ly:ry, lx:rx]
-            img_np_list[_i] = _inp
+            img_np_list[_i] = self.apply_crop(img_np_list[_i], rsize, crop, quad, still=still)
         return img_np_list, crop, quad
 
@@ -31,8 +31,7 @@ def enhancer_generator_with_len(images, method='gfpgan', bg_upsampler='realesrga
     """ Provide a generator with a __len__ method so that it can passed to functions that
     call len()"""
 
-    if os.path.isfile(images): # handle video to images
-        # TODO: Create a generator version of load_video_to_cv2
+    if isinstance(images, str) and os.path.isfile(images): # handle video to images, streamed with a known length
         images = load_video_to_cv2(images)
 
     gen = enhancer_generator_no_len(images, method=method, bg_upsampler=bg_upsampler)
@@ -45,7 +44,7 @@ def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'
     the enhancer function. """
 
     print('face enhancer....')
-    if not isinstance(images, list) and os.path.isfile(images): # handle video to images
+    if isinstance(images, str) and os.path.isfile(images): # handle video to images
         images = load_video_to_cv2(images)
 
     # ------------------------ set up GFPGAN restorer ------------------------
@@ -108,9 +107,9 @@ def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'
         bg_upsampler=bg_upsampler)
 
     # ------------------------ restore ------------------------
-    for idx in tqdm(range(len(images)), 'Face Enhancer:'):
+    for image in tqdm(images, 'Face Enhancer:'):
         
-        img = cv2.cvtColor(images[idx], cv2.COLOR_RGB2BGR)
+        img = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
         
         # restore faces and background if necessary
         cropped_faces, restored_faces, r_img = restorer.enhance(
@@ -1,11 +1,57 @@
 import cv2, os
 import numpy as np
 from tqdm import tqdm
-import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from src.utils.videoio import save_video_with_watermark 
+from src.utils.videoio import VideoWriter, FrameReader
 
-def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop=False):
+def clone_frame(crop_frame, full_img, box):
+    ox1, oy1, ox2, oy2 = box
+    p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1)) 
+
+    mask = 255*np.ones(p.shape, p.dtype)
+    location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
+    return cv2.seamlessClone(p, full_img, mask, location, cv2.NORMAL_CLONE)
+
+def feather_mask(h, w, feather):
+    """
+    Alpha mask (h, w, 1) that is 1 inside and fades linearly to 0 over `feather` pixels at the border
+    """
+    y = np.minimum(np.arange(h), np.arange(h)[::-1])[:, None]
+    x = np.minimum(np.arange(w), np.arange(w)[::-1])[None, :]
+    alpha = np.clip((np.minimum(x, y) + 1) / (feather + 1), 0, 1)
+    return alpha[..., None].astype(np.float32)
+
+class FeatherBlender():
+    """
+    Alpha blend the pasted frame into the full image with a feathered mask. The background and the mask
+    never change within a video, so everything outside the crop box is computed once and every frame
+    only blends the crop box into a preallocated copy of the background.
+    """
+
+    def __init__(self, full_img, box, feather_ratio=0.1):
+        ox1, oy1, ox2, oy2 = box
+        self.box = box
+        self.canvas = full_img.copy()
+        self.alpha = feather_mask(oy2 - oy1, ox2 - ox1, max(1, int(feather_ratio * min(oy2 - oy1, ox2 - ox1))))
+        self.background = full_img[oy1:oy2, ox1:ox2].astype(np.float32) * (1 - self.alpha)
+
+    def __call__(self, crop_frame):
+        ox1, oy1, ox2, oy2 = self.box
+        p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1))
+        roi = p.astype(np.float32) * self.alpha + self.background
+        self.canvas[oy1:oy2, ox1:ox2] = np.clip(roi + 0.5, 0, 255).astype(np.uint8)
+        # the canvas is reused by the next frame, write it out before calling again
+        return self.canvas
+
+def paste_pic(video_path, pic_path, crop_info, audio_path, full_video_path, extended_crop=False, duration=None, encoder=None, workers=None,
+              blend='seamless'):
+    """
+    Paste the cropped video back into the full image. The frames are decoded, blended and encoded as a stream.
+    blend: seamless, cv2.seamlessClone on `workers` threads (default: one per cpu core) with the frame order kept
+           feather, alpha blend inside the crop box with a feathered border, a small fraction of the seamless cost
+    """
 
     if not os.path.isfile(pic_path):
         raise ValueError('pic_path must be a valid path to video/image file')
@@ -13,30 +59,9 @@ def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path,
         # loader for first frame
         full_img = cv2.imread(pic_path)
     else:
-        # loader for videos
-        video_stream = cv2.VideoCapture(pic_path)
-        fps = video_stream.get(cv2.CAP_PROP_FPS)
-        full_frames = [] 
-        while 1:
-            still_reading, frame = video_stream.read()
-            if not still_reading:
-                video_stream.release()
-                break 
-            break 
-        full_img = frame
-    frame_h = full_img.shape[0]
-    frame_w = full_img.shape[1]
+        # loader for videos, only the first frame is used
+        full_img = next(iter(FrameReader(pic_path, max_frames=1)), None)
 
-    video_stream = cv2.VideoCapture(video_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    crop_frames = []
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
-            video_stream.release()
-            break
-        crop_frames.append(frame)
-    
     if len(crop_info) != 3:
         print("you didn't crop the image")
         return
@@ -53,17 +78,26 @@ def paste_pic(video_path, pic_path, crop_info, new_audio_path, full_video_path,
         else:
             oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
 
-    tmp_path = str(uuid.uuid4())+'.mp4'
-    out_tmp = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*'MP4V'), fps, (frame_w, frame_h))
-    for crop_frame in tqdm(crop_frames, 'seamlessClone:'):
-        p = cv2.resize(crop_frame.astype(np.uint8), (ox2-ox1, oy2 - oy1)) 
-
-        mask = 255*np.ones(p.shape, p.dtype)
-        location = ((ox1+ox2) // 2, (oy1+oy2) // 2)
-        gen_img = cv2.seamlessClone(p, full_img, mask, location, cv2.NORMAL_CLONE)
-        out_tmp.write(gen_img)
-
-    out_tmp.release()
+    crop_frames = FrameReader(video_path)
+    fps = crop_frames.fps
 
-    save_video_with_watermark(tmp_path, new_audio_path, full_video_path, watermark=False)
-    os.remove(tmp_path)
+    if blend not in ('seamless', 'feather'):
+        raise ValueError('unknown blend mode %s' % blend)
+    box = (ox1, oy1, ox2, oy2)
+    workers = workers or os.cpu_count() or 1
+    # at most 2 frames per worker are in flight, memory does not grow with the video length
+    pending = deque()
+    # the audio is muxed from audio_path (cut to duration seconds) while encoding
+    with VideoWriter(full_video_path, fps=fps, audio_path=audio_path, duration=duration, pix_fmt='bgr24', encoder=encoder) as out_tmp, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        if blend == 'feather':
+            blender = FeatherBlender(full_img, box)
+            for crop_frame in tqdm(crop_frames, 'featherBlend:'):
+                out_tmp.write(blender(crop_frame))
+            return
+        for crop_frame in tqdm(crop_frames, 'seamlessClone:'):
+            pending.append(pool.submit(clone_frame, crop_frame, full_img, box))
+            if len(pending) >= 2 * workers:
+                out_tmp.write(pending.popleft().result())
+        while pending:
+            out_tmp.write(pending.popleft().result())
@@ -2,6 +2,8 @@ import numpy as np
 import cv2, os, sys, torch
 from tqdm import tqdm
 from PIL import Image 
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 
 # 3dmm extraction
 import safetensors
@@ -12,6 +14,7 @@ from src.face3d.models import networks
 
 from scipy.io import loadmat, savemat
 from src.utils.croper import Preprocesser
+from src.utils.videoio import FrameReader
 
 
 import warnings
@@ -43,8 +46,28 @@ def split_coeff(coeffs):
         }
 
 
+def align_frame(frame, lm, lm3d_std):
+    """
+    Align a frame to the standard 3d landmarks, return the (5,) trans params and the 224x224 uint8 crop
+    """
+    W,H = frame.size
+    lm1 = lm.reshape([-1, 2]).copy()
+
+    if np.mean(lm1) == -1:
+        lm1 = (lm3d_std[:, :2]+1)/2.
+        lm1 = np.concatenate(
+            [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
+        )
+    else:
+        lm1[:, -1] = H - 1 - lm1[:, -1]
+
+    trans_params, im1, lm1, _ = align_img(frame, lm1, lm3d_std)
+    trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+    return trans_params, np.array(im1)
+
+
 class CropAndExtract():
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, recon_batch_size=32, align_workers=None):
 
         self.propress = Preprocesser(device)
         self.net_recon = networks.define_net_recon(net_recon='resnet50', use_last_fc=False, init_path='').to(device)
@@ -59,8 +82,11 @@ class CropAndExtract():
         self.net_recon.eval()
         self.lm3d_std = load_lm3d(sadtalker_path['dir_of_BFM_fitting'])
         self.device = device
+        # frames per net_recon batch, and the cpu pool that aligns the frames
+        self.recon_batch_size = recon_batch_size
+        self.align_pool = ThreadPoolExecutor(max_workers=align_workers or os.cpu_count() or 1)
     
-    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256):
+    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256, batch_size=None, kp_track_interval=0):
 
         pic_name = os.path.splitext(os.path.split(input_path)[-1])[0]  
 
@@ -73,47 +99,35 @@ class CropAndExtract():
             raise ValueError('input_path must be a valid path to video/image file')
         elif input_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
             # loader for first frame
-            full_frames = [cv2.imread(input_path)]
+            x_full_frames = iter([cv2.cvtColor(cv2.imread(input_path), cv2.COLOR_BGR2RGB)])
             fps = 25
         else:
-            # loader for videos
-            video_stream = cv2.VideoCapture(input_path)
-            fps = video_stream.get(cv2.CAP_PROP_FPS)
-            full_frames = [] 
-            while 1:
-                still_reading, frame = video_stream.read()
-                if not still_reading:
-                    video_stream.release()
-                    break 
-                full_frames.append(frame) 
-                if source_image_flag:
-                    break
-
-        x_full_frames= [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  for frame in full_frames] 
+            # loader for videos, the full resolution frames are streamed and only the resized crops are kept
+            x_full_frames = FrameReader(input_path, rgb=True, max_frames=1 if source_image_flag else None)
+            fps = x_full_frames.fps
+            x_full_frames = iter(x_full_frames)
+
+        first_frame = next(x_full_frames, None)
+        if first_frame is None:
+            print('No face is detected in the input file')
+            return None, None, None
 
         #### crop images as the 
-        if 'crop' in crop_or_resize.lower(): # default crop
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
-            clx, cly, crx, cry = crop
-            lx, ly, rx, ry = quad
-            lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-            oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-            crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
-        elif 'full' in crop_or_resize.lower():
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
+        if 'crop' in crop_or_resize.lower() or 'full' in crop_or_resize.lower(): # default crop
+            still = True if 'ext' in crop_or_resize.lower() else False
+            rsize, crop, quad = self.propress.crop_params(first_frame, xsize=512)
             clx, cly, crx, cry = crop
             lx, ly, rx, ry = quad
             lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
             oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
             crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
+            transform = lambda frame: self.propress.apply_crop(frame, rsize, crop, quad, still=still)
         else: # resize mode
-            oy1, oy2, ox1, ox2 = 0, x_full_frames[0].shape[0], 0, x_full_frames[0].shape[1] 
+            oy1, oy2, ox1, ox2 = 0, first_frame.shape[0], 0, first_frame.shape[1] 
             crop_info = ((ox2 - ox1, oy2 - oy1), None, None)
+            transform = lambda frame: frame
 
-        frames_pil = [Image.fromarray(cv2.resize(frame,(pic_size, pic_size))) for frame in x_full_frames]
-        if len(frames_pil) == 0:
-            print('No face is detected in the input file')
-            return None, None
+        frames_pil = [Image.fromarray(cv2.resize(transform(frame),(pic_size, pic_size))) for frame in chain([first_frame], x_full_frames)]
 
         # save crop info
         for frame in frames_pil:
@@ -121,33 +135,32 @@ class CropAndExtract():
 
         # 2. get the landmark according to the detected face. 
         if not os.path.isfile(landmarks_path): 
-            lm = self.propress.predictor.extract_keypoint(frames_pil, landmarks_path)
+            lm = self.propress.predictor.extract_keypoint(frames_pil, landmarks_path, track_interval=kp_track_interval)
         else:
             print(' Using saved landmarks.')
             lm = np.loadtxt(landmarks_path).astype(np.float32)
-            lm = lm.reshape([len(x_full_frames), -1, 2])
+            lm = lm.reshape([len(frames_pil), -1, 2])
 
         if not os.path.isfile(coeff_path):
             # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
+            batch_size = batch_size or self.recon_batch_size
+            frame_num = len(frames_pil)
+
+            # align the next batch on the cpu pool while net_recon runs on the current one
+            def submit_alignment(start):
+                return [self.align_pool.submit(align_frame, frames_pil[idx], lm[idx], self.lm3d_std)
+                        for idx in range(start, min(start + batch_size, frame_num))]
+
             video_coeffs, full_coeffs = [],  []
-            for idx in tqdm(range(len(frames_pil)), desc='3DMM Extraction In Video:'):
-                frame = frames_pil[idx]
-                W,H = frame.size
-                lm1 = lm[idx].reshape([-1, 2])
-            
-                if np.mean(lm1) == -1:
-                    lm1 = (self.lm3d_std[:, :2]+1)/2.
-                    lm1 = np.concatenate(
-                        [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
-                    )
-                else:
-                    lm1[:, -1] = H - 1 - lm1[:, -1]
-
-                trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
- 
-                trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
-                im_t = torch.tensor(np.array(im1)/255., dtype=torch.float32).permute(2, 0, 1).to(self.device).unsqueeze(0)
-                
+            next_jobs = submit_alignment(0)
+            for start in tqdm(range(0, frame_num, batch_size), desc='3DMM Extraction In Video:'):
+                jobs, next_jobs = next_jobs, submit_alignment(start + batch_size)
+                aligned = [job.result() for job in jobs]
+                trans_params = np.stack([item[0] for item in aligned])
+                # one host to device copy per batch
+                im_t = torch.from_numpy(np.stack([item[1] for item in aligned])).to(self.device)
+                im_t = im_t.permute(0, 3, 1, 2).float() / 255.
+
                 with torch.no_grad():
                     full_coeff = self.net_recon(im_t)
                     coeffs = split_coeff(full_coeff)
@@ -158,13 +171,13 @@ class CropAndExtract():
                     pred_coeff['exp'], 
                     pred_coeff['angle'],
                     pred_coeff['trans'],
-                    trans_params[2:][None],
+                    trans_params[:, 2:],
                     ], 1)
                 video_coeffs.append(pred_coeff)
                 full_coeffs.append(full_coeff.cpu().numpy())
 
-            semantic_npy = np.array(video_coeffs)[:,0] 
+            semantic_npy = np.concatenate(video_coeffs, 0)
 
-            savemat(coeff_path, {'coeff_3dmm': semantic_npy, 'full_3dmm': np.array(full_coeffs)[0]})
+            savemat(coeff_path, {'coeff_3dmm': semantic_npy, 'full_3dmm': np.concatenate(full_coeffs, 0)[:1]})
 
         return coeff_path, png_path, crop_info
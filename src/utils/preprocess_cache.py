@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+class PreprocessCache():
+    """
+    Content-addressed store of the CropAndExtract.generate results on disk. An entry is a directory named
+    by the sha256 of the input file and of the settings that change the result, it holds the coeff mat,
+    the crop png, the landmarks and the crop_info. The least recently used entries are evicted once the
+    cache grows over max_size bytes.
+
+    Several processes may share cache_dir: an entry is written to a temporary directory and renamed into
+    place, a read that races with an eviction is a miss.
+    """
+
+    # file in the entry: suffix of the file CropAndExtract.generate writes
+    FILES = {'coeff.mat': '.mat', 'crop.png': '.png', 'landmarks.txt': '_landmarks.txt'}
+
+    def __init__(self, cache_dir, max_size=1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, input_path, *settings):
+        return hashlib.sha256('\n'.join([file_hash(input_path)] + [str(s) for s in settings]).encode('utf-8')).hexdigest()
+
+    def get(self, key, save_dir, pic_name):
+        """
+        Copy the entry `key` into save_dir under the names CropAndExtract.generate uses for pic_name.
+        Return (coeff_path, png_path, crop_info) like CropAndExtract.generate, or None on a miss.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        paths = {}
+        try:
+            with open(os.path.join(entry, 'crop_info.json')) as f:
+                crop_info = tuple(tuple(item) if isinstance(item, list) else item for item in json.load(f))
+            for name, suffix in self.FILES.items():
+                if os.path.isfile(os.path.join(entry, name)):
+                    paths[name] = os.path.join(save_dir, pic_name + suffix)
+                    shutil.copyfile(os.path.join(entry, name), paths[name])
+            # the mtime of the entry is its last use
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        if 'coeff.mat' not in paths:
+            return None
+        return paths['coeff.mat'], paths.get('crop.png'), crop_info
+
+    def put(self, key, coeff_path, png_path, crop_info, landmarks_path=None):
+        """
+        Store the results of CropAndExtract.generate as the entry `key`, then evict down to max_size
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+        tmp_dir = os.path.join(self.cache_dir, '.tmp-' + uuid.uuid4().hex)
+        os.makedirs(tmp_dir)
+        try:
+            for name, path in zip(self.FILES, [coeff_path, png_path, landmarks_path]):
+                if path is not None and os.path.isfile(path):
+                    shutil.copyfile(path, os.path.join(tmp_dir, name))
+            with open(os.path.join(tmp_dir, 'crop_info.json'), 'w') as f:
+                # the quad holds numpy scalars
+                json.dump(crop_info, f, default=lambda o: o.tolist())
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if name.startswith('.tmp-'):
+                    # left over by a process that died while writing
+                    if time.time() - os.path.getmtime(path) > 3600:
+                        shutil.rmtree(path, ignore_errors=True)
+                    continue
+                entries.append((os.path.getmtime(path), dir_size(path), name))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+            total -= size
@@ -1,21 +1,110 @@
 import shutil
 import uuid
+import subprocess
+import threading
+from queue import Queue, Full
 
 import os
 
 import cv2
+import numpy as np
+import imageio_ffmpeg
 
-def load_video_to_cv2(input_path):
-    video_stream = cv2.VideoCapture(input_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    full_frames = [] 
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
+class FrameReader():
+    """
+    Stream the frames of a video instead of decoding the whole video into a list. The frames are
+    decoded on a background thread, at most `prefetch` frames ahead of the consumer, and every
+    iteration decodes the video again from the start.
+    len() is the frame count of the container metadata after stride and max_frames.
+
+    stride: keep every stride-th frame
+    size: resize the frames to (w, h)
+    rgb: convert the frames from BGR to RGB
+    max_frames: stop after this many frames
+    """
+
+    def __init__(self, path, stride=1, size=None, rgb=False, max_frames=None, prefetch=16):
+        if not os.path.isfile(path):
+            raise ValueError('%s is not a valid video file' % path)
+        self.path = path
+        self.stride = stride
+        self.size = size
+        self.rgb = rgb
+        self.max_frames = max_frames
+        self.prefetch = prefetch
+
+        video_stream = cv2.VideoCapture(path)
+        self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+        frame_count = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        video_stream.release()
+        self.length = max(0, (frame_count + stride - 1) // stride)
+        if max_frames is not None:
+            self.length = min(self.length, max_frames)
+
+    def __len__(self):
+        return self.length
+
+    def decode(self, frames, stop, errors):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        video_stream = cv2.VideoCapture(self.path)
+        try:
+            index = kept = 0
+            while self.max_frames is None or kept < self.max_frames:
+                if index % self.stride:
+                    still_reading = video_stream.grab()
+                    frame = None
+                else:
+                    still_reading, frame = video_stream.read()
+                if not still_reading:
+                    break
+                index += 1
+                if frame is None:
+                    continue
+                if self.size is not None:
+                    frame = cv2.resize(frame, tuple(self.size))
+                if self.rgb:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                if not put(frame):
+                    return
+                kept += 1
+        except Exception as e:
+            errors.append(e)
+        finally:
             video_stream.release()
-            break 
-        full_frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-    return full_frames
+            put(None)
+
+    def __iter__(self):
+        frames = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        errors = []
+        thread = threading.Thread(target=self.decode, args=(frames, stop, errors), daemon=True)
+        thread.start()
+        try:
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    break
+                yield frame
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            thread.join()
+
+
+def load_video_to_cv2(input_path, **kwargs):
+    """
+    Return the RGB frames of the video as a FrameReader, the frames are decoded lazily while iterating
+    """
+    return FrameReader(input_path, rgb=True, **kwargs)
 
 def save_video_with_watermark(video, audio, save_path, watermark=False):
     temp_file = str(uuid.uuid4())+'.mp4'
@@ -38,4 +127,92 @@ def save_video_with_watermark(video, audio, save_path, watermark=False):
 
         cmd = r'ffmpeg -y -hide_banner -loglevel error -i "%s" -i "%s" -filter_complex "[1]scale=100:-1[wm];[0][wm]overlay=(main_w-overlay_w)-10:10" "%s"' % (temp_file, watarmark_path, save_path)
         os.system(cmd)
-        os.remove(temp_file)
\ No newline at end of file
+        os.remove(temp_file)
+
+
+# codec, preset, crf, threads (0: let ffmpeg decide) and pix_fmt of the output videos
+ENCODER_PROFILES = {
+    'default': {'codec': 'libx264', 'preset': 'medium', 'crf': 25, 'threads': 0, 'pix_fmt': 'yuv420p'},
+    # throughput oriented, for batch jobs
+    'fast': {'codec': 'libx264', 'preset': 'veryfast', 'crf': 25, 'threads': 0, 'pix_fmt': 'yuv420p'},
+    'ultrafast': {'codec': 'libx264', 'preset': 'ultrafast', 'crf': 23, 'threads': 0, 'pix_fmt': 'yuv420p'},
+    # smaller files, slower encode
+    'small': {'codec': 'libx264', 'preset': 'slow', 'crf': 28, 'threads': 0, 'pix_fmt': 'yuv420p'},
+    # nvidia hardware encoder, needs an ffmpeg built with nvenc
+    'nvenc': {'codec': 'h264_nvenc', 'preset': 'fast', 'crf': 25, 'threads': 0, 'pix_fmt': 'yuv420p'},
+}
+
+def get_encoder_profile(name='default', **overrides):
+    """
+    Return the encoder profile `name` with the not None `overrides` (codec, preset, crf, threads, pix_fmt) applied
+    """
+    if name not in ENCODER_PROFILES:
+        raise ValueError('unknown encoder profile %s, choose from %s' % (name, ', '.join(ENCODER_PROFILES)))
+    profile = dict(ENCODER_PROFILES[name])
+    profile.update({k: v for k, v in overrides.items() if v is not None})
+    return profile
+
+
+class VideoWriter():
+    """
+    Encode frames into save_path with a single ffmpeg process: the raw frames are piped on stdin and
+    the audio track is read straight from audio_path, cut to `duration` seconds, so the video is
+    encoded and muxed in one pass without temporary files.
+    The size of the video is taken from the first frame, encoder is a profile from get_encoder_profile.
+    """
+
+    def __init__(self, save_path, fps=25, audio_path=None, duration=None, pix_fmt='rgb24', encoder=None):
+        self.save_path = save_path
+        self.encoder = encoder if encoder is not None else ENCODER_PROFILES['default']
+        self.fps = fps
+        self.audio_path = audio_path
+        self.duration = duration
+        self.pix_fmt = pix_fmt
+        self.process = None
+
+    def command(self, width, height):
+        cmd = [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-hide_banner', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', self.pix_fmt, '-s', '%dx%d' % (width, height), '-r', str(self.fps), '-i', '-']
+        if self.audio_path is not None:
+            if self.duration is not None:
+                cmd += ['-ss', '0', '-t', '%.3f' % self.duration]
+            cmd += ['-i', self.audio_path, '-map', '0:v:0', '-map', '1:a:0?']
+        # yuv420p needs an even width and height
+        encoder = self.encoder
+        cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-vcodec', encoder['codec'], '-pix_fmt', encoder['pix_fmt']]
+        if encoder.get('preset'):
+            cmd += ['-preset', str(encoder['preset'])]
+        if encoder.get('crf') is not None:
+            # nvenc has no crf, its constant quality mode is -cq
+            cmd += ['-cq' if 'nvenc' in encoder['codec'] else '-crf', str(encoder['crf'])]
+        if encoder.get('threads'):
+            cmd += ['-threads', str(encoder['threads'])]
+        if self.audio_path is not None:
+            cmd += ['-acodec', 'aac']
+        return cmd + [self.save_path]
+
+    def write(self, frame):
+        if self.process is None:
+            height, width = frame.shape[:2]
+            self.process = subprocess.Popen(self.command(width, height), stdin=subprocess.PIPE)
+        self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('ffmpeg failed to write %s' % self.save_path)
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_video(frames, save_path, fps=25, audio_path=None, duration=None, pix_fmt='rgb24', encoder=None):
+    with VideoWriter(save_path, fps=fps, audio_path=audio_path, duration=duration, pix_fmt=pix_fmt, encoder=encoder) as writer:
+        for frame in frames:
+            writer.write(frame)